@@ -0,0 +1,725 @@
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+import warnings
+
+import numpy as np
+import cv2
+import process_image as process
+import lane_detection as lane
+import lane_kernels as kernels
+import frame_ingest as ingest
+import synthetic_scene
+import lane_geometry as geometry
+from frame_source import SyntheticSource
+from frame_recorder import FrameRecorder, FrameReplayer
+from departure_warning import DeparturePredictor
+from frame_pipeline import FramePipeline
+from process_detection import ProcessDetector
+
+
+#---time_call()----
+
+
+def time_call(func, repeats=50, warmup=3):
+    # run func a few times to warm caches, then report the mean and best per-call time in ms
+    for _ in range(warmup):
+        func()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return np.mean(times)*1000, np.min(times)*1000
+
+
+#---report()----
+
+
+def report(name, mean_ms, best_ms):
+    print("{:<52} mean {:8.3f} ms   best {:8.3f} ms".format(name, mean_ms, best_ms))
+
+
+#---check()----
+
+
+def check(passed, message):
+    # an agreement check of a benchmark: print it if it failed and return whether
+    # it passed. benchmarks return False when any of theirs failed, which makes
+    # the script exit with an error
+    if not passed:
+        print("CHECK FAILED: " + message)
+    return bool(passed)
+
+
+#---random_frame()----
+
+
+def random_frame(height, width, channels=4, seed=0):
+    # smoothed noise so the warps and filters have realistic work to do
+    rng = np.random.default_rng(seed)
+    frame = rng.integers(0, 256, (height, width, channels), dtype=np.uint8)
+    return cv2.GaussianBlur(frame, (9, 9), 0)
+
+
+#---lane_frame()----
+
+
+def lane_frame(height, width, seed=0):
+    # a gently curving synthetic road scene with a couple of shadows
+    return synthetic_scene.generate_scene(height, width, bend=0.05, shadows=2, seed=seed)[0]
+
+
+#---overlap()----
+
+
+def overlap(a, b):
+    # intersection over union of the nonzero pixels of two binary images
+    a, b = a > 0, b > 0
+    union = np.count_nonzero(a | b)
+    return np.count_nonzero(a & b)/union if union else 1.0
+
+
+#---pipeline_accuracy()----
+
+
+def pipeline_accuracy(detected, truth, height, width):
+    # mean horizontal error of the detected lines against the ground truth, in pixels and % of width
+    errors = [synthetic_scene.fit_error(fit, true_fit, height) for fit, true_fit in zip(detected, truth)]
+    return "left {:.1f} px right {:.1f} px ({:.2f}% of width)".format(errors[0], errors[1], 100*max(errors)/width)
+
+
+#---bench_perspective_warp()----
+
+
+def uncached_perspective_warp(img, height, width, warp_type):
+    # the original per-frame implementation, rebuilding the homography every call
+    if warp_type == "warp":
+        src, desired = np.float32(process.LANE_QUAD), np.float32(process.BIRDSEYE_QUAD)
+    else:
+        src, desired = np.float32(process.BIRDSEYE_QUAD), np.float32(process.LANE_QUAD)
+    src = src * np.float32([img.shape[1], img.shape[0]])
+    desired = desired * np.float32([width, height])
+    transform_matrix = cv2.getPerspectiveTransform(src, desired)
+    return cv2.warpPerspective(img, transform_matrix, (width, height))
+
+
+def bench_perspective_warp(height=720, width=1280, repeats=50):
+    binary = (random_frame(height, width, 1, seed=1) > 128).astype(np.uint8)
+    colour = random_frame(height, width, 3, seed=2)
+    for name, img, warp_type in (("warp binary", binary, "warp"), ("unwarp colour", colour, "")):
+        report("perspective_warp uncached " + name, *time_call(lambda: uncached_perspective_warp(img, height, width, warp_type), repeats))
+        warper = process.PerspectiveWarper()
+        report("perspective_warp cached " + name, *time_call(lambda: warper.warp(img, height, width, warp_type), repeats))
+
+
+#---bench_threshold_image()----
+
+
+def reference_threshold_image(img, sx_thresh=(25, 255)):
+    # the original float64 implementation, allocating every temporary per call
+    grey = cv2.cvtColor(img, cv2.COLOR_BGRA2GRAY)
+    sobel_x64f = cv2.Sobel(grey, cv2.CV_64F, 1, 0, ksize=5)
+    abs_sobel_x64f = np.absolute(sobel_x64f)
+    sobel_x8u = np.uint8(255*abs_sobel_x64f/np.max(abs_sobel_x64f))
+    sobel_x_binary = np.zeros_like(sobel_x8u)
+    sobel_x_binary[(sobel_x8u >= sx_thresh[0]) & (sobel_x8u <= sx_thresh[1])] = 1
+    return cv2.GaussianBlur(sobel_x_binary, (5,5), 0)
+
+
+def bench_threshold_image(height=720, width=1280, repeats=50):
+    frame = random_frame(height, width, 4, seed=3)
+    out = np.empty((height, width), np.uint8)
+    mismatched = np.count_nonzero(reference_threshold_image(frame) != process.threshold_image(frame))
+    report("threshold_image reference float64", *time_call(lambda: reference_threshold_image(frame), repeats))
+    report("threshold_image engine", *time_call(lambda: process.threshold_image(frame), repeats))
+    report("threshold_image engine out=", *time_call(lambda: process.threshold_image(frame, out=out), repeats))
+    print("pixels differing from reference: {}".format(mismatched))
+    return check(mismatched == 0, "threshold_image differs from the reference in {} pixels".format(mismatched))
+
+
+#---bench_process_image()----
+
+
+def bench_process_image(height=720, width=1280, repeats=50):
+    frame, truth = synthetic_scene.generate_scene(height, width, bend=0.05, shadows=2, seed=4)
+    # warp_first is known to lose the far dashes, only roi has to agree with full
+    full = process.process_image(frame, height, width, "full")
+    passed = True
+    for mode in ("full", "roi", "warp_first"):
+        result = process.process_image(frame, height, width, mode)
+        fits = lane.sliding_window(result)[2]
+        print("process_image {} IoU vs full {:.3f}, fit error {}".format(mode, overlap(full, result), pipeline_accuracy(fits, truth, height, width)))
+        if mode == "roi":
+            passed = check(overlap(full, result) >= 0.99, "roi binary image differs from full") and passed
+        report("process_image " + mode, *time_call(lambda: process.process_image(frame, height, width, mode), repeats))
+    return passed
+
+
+#---bench_lane_search()----
+
+
+def bench_lane_search(height=720, width=1280, repeats=50):
+    binary = process.process_image(lane_frame(height, width, seed=5), height, width)
+    tracker = lane.LaneTracker()
+    tracker.update(binary)
+    report("sliding_window full search", *time_call(lambda: lane.sliding_window(binary), repeats))
+    report("LaneTracker targeted search", *time_call(lambda: tracker.update(binary), repeats))
+    report("LaneTracker targeted search + debug image", *time_call(lambda: tracker.update(binary).debug_image(), repeats))
+    print("tracker: {}".format(tracker.stats()))
+
+
+#---bench_window_search()----
+
+
+def reference_bases(img):
+    # the original seeding, the highest column sum of either half of the bottom half
+    histogram = lane.histogram_values(img)
+    midpoint = int(histogram.shape[0]/2)
+    return np.argmax(histogram[:midpoint]), np.argmax(histogram[midpoint:]) + midpoint
+
+
+def reference_window_search(img, num_windows=9, margin=150, minpix=1):
+    # the original window loop, masking every nonzero pixel for every window
+    leftx_current, rightx_current = reference_bases(img)
+    window_height = int(img.shape[0]/num_windows)
+    nonzero_y, nonzero_x = img.nonzero()
+    left_lane_indices, right_lane_indices = [], []
+    for window in range(num_windows):
+        window_low_y = img.shape[0] - (window+1) * window_height
+        window_high_y = img.shape[0] - window * window_height
+        in_rows = (nonzero_y >= window_low_y) & (nonzero_y < window_high_y)
+        left = (in_rows & (nonzero_x >= leftx_current - margin) & (nonzero_x < leftx_current + margin)).nonzero()[0]
+        right = (in_rows & (nonzero_x >= rightx_current - margin) & (nonzero_x < rightx_current + margin)).nonzero()[0]
+        left_lane_indices.append(left)
+        right_lane_indices.append(right)
+        if len(left) > minpix:
+            leftx_current = int(np.mean(nonzero_x[left]))
+        if len(right) > minpix:
+            rightx_current = int(np.mean(nonzero_x[right]))
+    left_lane_indices = np.concatenate(left_lane_indices)
+    right_lane_indices = np.concatenate(right_lane_indices)
+    return ((nonzero_x[left_lane_indices], nonzero_y[left_lane_indices]),
+            (nonzero_x[right_lane_indices], nonzero_y[right_lane_indices]))
+
+
+def noisy_binary(height, width, density, seed=0):
+    # two vertical lane lines buried in uniformly scattered noise pixels
+    rng = np.random.default_rng(seed)
+    binary = (rng.random((height, width)) < density).astype(np.uint8)
+    for x in (int(width*0.3), int(width*0.7)):
+        binary[:, x - 5:x + 5] = 1
+    return binary
+
+
+def bench_window_search(height=720, width=1280, repeats=50):
+    passed = True
+    for density in (0.005, 0.02, 0.1, 0.3):
+        binary = noisy_binary(height, width, density)
+        count = np.count_nonzero(binary)
+        # both searches start from the same columns, so only the window loops differ
+        bases = reference_bases(binary)
+        expected = reference_window_search(binary)
+        result = lane.window_search(binary, bases=bases)
+        same = all(np.array_equal(a, b) for a, b in zip(expected[0] + expected[1], result[0] + result[1]))
+        report("window search reference {:>7} px".format(count), *time_call(lambda: reference_window_search(binary), repeats))
+        report("window search banded    {:>7} px{}".format(count, "" if same else " MISMATCH"),
+               *time_call(lambda: lane.window_search(binary, bases=bases), repeats))
+        passed = check(same, "banded window search finds other pixels than the reference at density {}".format(density)) and passed
+    return passed
+
+
+#---bench_seeding()----
+
+
+SEEDING_SCENES = (
+    ("one lane", dict(dashed=(False, True))),
+    ("three lanes", dict(dashed=(True, True), lane_width=0.25, adjacent=1)),
+    ("straddling a line", dict(dashed=(True, False), lane_width=0.25, adjacent=1, lane_centre=0.605)),
+)
+
+
+def bench_seeding(height=720, width=1280, repeats=50):
+    # where the window search starts: the original column sums of the bottom half
+    # split at the midpoint, against the peaks of the binned column histogram.
+    # errors are of the ego lane's starting columns against the true lines'
+    # bottom columns, which have to be within two histogram bins
+    passed = True
+    for name, scene in SEEDING_SCENES:
+        frame, truth = synthetic_scene.generate_scene(height, width, bend=0.04, seed=9, **scene)
+        lines = synthetic_scene.lane_lines(height, width, 0.04, scene.get("lane_centre", 0.5),
+                                           scene.get("lane_width", 0.4), scene.get("adjacent", 0))
+        binary = process.process_image(frame, height, width)
+        true_bases = [np.polyval(fit, height - 1) for fit in truth]
+        visible = sum(0 <= np.polyval(fit, height - 1) < width for fit in lines)
+
+        old = reference_bases(binary)
+        positions, ego = lane.lane_bases(binary)
+        old_error = max(abs(found - true) for found, true in zip(old, true_bases))
+        new_error = max(abs(positions[i] - true) for i, true in zip(ego, true_bases))
+        print("{}: {} lines visible, {} found, ego lane start error: halves {:.1f} px, peaks {:.1f} px".format(
+            name, visible, len(positions), old_error, new_error))
+        passed = check(len(positions) == visible and new_error <= 16,
+                       "{}: seeding found {} of {} lines, {:.1f} px off".format(name, len(positions), visible, new_error)) and passed
+
+    report("seeding column sums + argmax", *time_call(lambda: reference_bases(binary), repeats))
+    report("seeding histogram peaks", *time_call(lambda: lane.lane_bases(binary), repeats))
+    tracker = lane.LaneTracker()
+    detection = tracker.update(binary)
+    print("tracker follows {} lines, ego lane is lines {}".format(len(detection.lines), detection.ego))
+    passed = check(len(detection.lines) == len(positions), "tracker follows {} of {} lines".format(
+        len(detection.lines), len(positions))) and passed
+    report("LaneTracker full search, every line", *time_call(lambda: tracker.reset() or tracker.update(binary), repeats))
+    tracker.update(binary)
+    report("LaneTracker targeted search, every line", *time_call(lambda: tracker.update(binary), repeats))
+    return passed
+
+
+#---bench_kernels()----
+
+
+def bench_kernels(height=720, width=1280, repeats=50, tolerance=1e-6):
+    # the window scan and quadratic fits of each available backend against the
+    # numpy scan and np.polyfit, checking they find the same pixels and lines:
+    # plain and weighted fits, and pixels from fewer than three rows, which
+    # np.polyfit can't fit exactly. returns False if any backend differs, which
+    # makes the benchmark script exit with an error
+    frame, _ = synthetic_scene.generate_scene(height, width, bend=0.04, dashed=(True, True), lane_width=0.25,
+                                              adjacent=1, seed=10)
+    binary = process.process_image(frame, height, width)
+    nonzero_y, nonzero_x = binary.nonzero()
+    band_starts = np.searchsorted(nonzero_y, height - np.arange(10)*(height//9), side="left")
+    bases, _ = lane.lane_bases(binary)
+    expected = kernels._window_scan_numpy(nonzero_x, band_starts, bases, 150, 1)
+    line_pixels = [(nonzero_y[expected[1][start:end]], nonzero_x[expected[1][start:end]])
+                   for start, end in zip(expected[2][:-1], expected[2][1:])]
+    weights = np.random.default_rng(10).random(len(line_pixels[0][0]))
+    rows = np.arange(height)
+    y, x = line_pixels[0]
+    two_rows = np.isin(y, y[[0, -1]])
+    few_rows = ((y[two_rows], x[two_rows], None), (y[:2], x[:2], None), (y[:2], x[:2], weights[:2]))
+
+    def difference(y, x, w=None):
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", np.exceptions.RankWarning)
+            return np.abs(np.polyval(kernels.fit_quadratic(y, x, w), rows) - np.polyval(np.polyfit(y, x, 2, w=w), rows)).max()
+
+    print("lane kernels: {} selected, available: {}".format(kernels.BACKEND, ", ".join(kernels.BACKENDS)))
+    if "numba" not in kernels.BACKENDS:
+        print("numba is not installed, only the numpy kernels are checked")
+    report("np.polyfit x{}".format(len(line_pixels)),
+           *time_call(lambda: [np.polyfit(y, x, 2) for y, x in line_pixels], repeats))
+    selected = kernels.BACKEND
+    passed = True
+    try:
+        for backend in kernels.BACKENDS:
+            kernels.use_backend(backend)
+            result = kernels.window_scan(nonzero_x, band_starts, bases, 150, 1)
+            same = all(np.array_equal(a, b) for a, b in zip(expected, result))
+            error = max(difference(y, x) for y, x in line_pixels)
+            weighted_error = difference(y, x, weights)
+            few_rows_error = max(difference(*pixels) for pixels in few_rows)
+            matches = bool(same and max(error, weighted_error, few_rows_error) <= tolerance)
+            passed = passed and matches
+            print("{}: window scan {}, largest difference from np.polyfit {:.1e} px, weighted {:.1e} px, "
+                  "fewer than three rows {:.1e} px{}".format(backend, "matches" if same else "MISMATCH", error,
+                                                            weighted_error, few_rows_error, "" if matches else " FAILED"))
+            report("{} window scan, {} lines".format(backend, len(bases)),
+                   *time_call(lambda: kernels.window_scan(nonzero_x, band_starts, bases, 150, 1), repeats))
+            report("{} fit_quadratic x{}".format(backend, len(line_pixels)),
+                   *time_call(lambda: [kernels.fit_quadratic(y, x) for y, x in line_pixels], repeats))
+            report("{} LaneTracker full search".format(backend),
+                   *time_call(lambda: lane.LaneTracker().update(binary), repeats))
+    finally:
+        kernels.use_backend(selected)
+    return passed
+
+
+#---bench_ingest()----
+
+
+class RawImage(object):
+    # stands in for a carla.Image in the ingest benchmark
+    def __init__(self, frame):
+        self.height, self.width = frame.shape[:2]
+        self.raw_data = memoryview(frame.tobytes())
+
+
+def bench_ingest(height=720, width=1280, repeats=50):
+    import pygame
+    data = RawImage(random_frame(height, width, 4, seed=6))
+    pool = ingest.BufferPool((height, width, 4), size=2)
+    surface = ingest.PersistentSurface(width, height)
+
+    def copy_and_make_surface():
+        img = np.reshape(np.copy(data.raw_data), (data.height, data.width, 4))
+        img = img[:, :, :3][:, :, ::-1]
+        return pygame.surfarray.make_surface(img.swapaxes(0, 1))
+
+    def pooled_ingest_and_update():
+        img = ingest.ingest_frame(data, pool)
+        surface.update(img)
+        pool.release(img)
+
+    report("ingest copy + make_surface", *time_call(copy_and_make_surface, repeats))
+    report("ingest pooled + persistent surface", *time_call(pooled_ingest_and_update, repeats))
+
+
+#---bench_display()----
+
+
+def bench_display(height=720, width=1280, repeats=50):
+    # a game loop tick's worth of display work for four panes: every pane blitted
+    # and the whole window flipped, against only the panes with a new frame, one
+    # or two of them here, updated through dirty rectangles, at full size and as
+    # a half size preview
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    import pygame
+    from renderer import Renderer
+    pygame.init()
+    frame = random_frame(height, width, 4, seed=7)
+
+    display = pygame.display.set_mode((width*2, height*2))
+    surfaces = [ingest.PersistentSurface(width, height) for _ in range(4)]
+    positions = [(0, 0), (width, 0), (0, height), (width, height)]
+    def flip_every_pane():
+        for surface in surfaces[:2]:
+            surface.update(frame)
+        for surface, position in zip(surfaces, positions):
+            display.blit(surface.surface, position)
+        pygame.display.flip()
+    report("display all panes + flip", *time_call(flip_every_pane, repeats))
+
+    for preview_scale in (1.0, 0.5):
+        renderer = Renderer(width, height, preview_scale=preview_scale)
+        panes = [renderer.add_pane(str(i)) for i in range(4)]
+        renderer.present(renderer.draw())
+        def dirty_panes():
+            for pane in panes[:2]:
+                pane.update(frame)
+            renderer.present(renderer.draw())
+        report("display dirty panes, preview scale {}".format(preview_scale), *time_call(dirty_panes, repeats))
+    pygame.quit()
+
+
+#---bench_pipeline()----
+
+
+RESOLUTIONS = (("720p", 720, 1280), ("1080p", 1080, 1920), ("4K", 2160, 3840))
+
+
+def bench_pipeline(repeats=50, resolutions=RESOLUTIONS):
+    font = cv2.FONT_HERSHEY_DUPLEX
+    for name, height, width in resolutions:
+        frame, truth = synthetic_scene.generate_scene(height, width, bend=0.08, dashed=(False, True), shadows=3, seed=7)
+        binary = process.threshold_image(frame)
+        warped = process.perspective_warp(binary, height, width, "warp")
+        rgb = ingest.bgra_to_rgb(frame).copy()
+        _, curves, fits = lane.sliding_window(warped)
+        tracker = lane.LaneTracker()
+        tracker.update(warped)
+
+        # everything lane_tracking_stage and lane_processing_stage do for one frame
+        def callback_equivalent():
+            img_ = process.process_image(frame, height, width)
+            detection = tracker.update(img_)
+            left, right = detection.lanes
+            curve_radius = lane.find_curve(img_, left, right)
+            lanes = lane.draw_lines(ingest.bgra_to_rgb(frame), left, right, height, width)
+            for row, text in enumerate(("Dist. from center: {:.4f} m".format(curve_radius[2]),
+                                        "Lane curvature: {:.0f} m".format(np.mean(curve_radius[:2])),
+                                        "Vehicle speed: {:.1f} mph".format(0.0))):
+                cv2.putText(lanes, text, (10, height - 10 - 20*row), font, 0.5, (0, 0, 0), 1)
+            return detection
+
+        print("{} ({}x{}), full search accuracy: {}".format(name, width, height, pipeline_accuracy(fits, truth, height, width)))
+        report(name + " threshold_image", *time_call(lambda: process.threshold_image(frame), repeats))
+        report(name + " perspective_warp", *time_call(lambda: process.perspective_warp(binary, height, width, "warp"), repeats))
+        report(name + " sliding_window", *time_call(lambda: lane.sliding_window(warped), repeats))
+        report(name + " LaneTracker.update", *time_call(lambda: tracker.update(warped), repeats))
+        report(name + " find_curve", *time_call(lambda: lane.find_curve(warped, fits[0], fits[1]), repeats))
+        report(name + " draw_lines", *time_call(lambda: lane.draw_lines(rgb, curves[0], curves[1], height, width), repeats))
+        report(name + " lane_detection_callback equivalent", *time_call(callback_equivalent, repeats))
+        print("{} tracked accuracy: {}".format(name, pipeline_accuracy(callback_equivalent().lanes, truth, height, width)))
+
+
+#---bench_find_curve()----
+
+
+def reference_find_curve(img, left_fit, right_fit):
+    # the original curvature calculation, refitting 720 evaluated points in metres
+    polyline = np.linspace(0, img.shape[0]-1, img.shape[0])
+    y_eval = np.max(polyline)
+    meters_pp_y = 25/720
+    meters_pp_x = 3/1280
+    new_left_fit = np.polyfit(polyline*meters_pp_y, left_fit*meters_pp_x, 2)
+    new_right_fit = np.polyfit(polyline*meters_pp_y, right_fit*meters_pp_x, 2)
+    left_curveradius = ((1 + (2*new_left_fit[0]*y_eval*meters_pp_y + new_left_fit[1])**2)**1.5) / np.absolute(2*new_left_fit[0])
+    right_curveradius = ((1 + (2*new_right_fit[0]*y_eval*meters_pp_y + new_right_fit[1])**2)**1.5) / np.absolute(2*new_right_fit[0])
+    return left_curveradius, right_curveradius
+
+
+def bench_find_curve(height=720, width=1280, repeats=50, streams=64):
+    frame, _ = synthetic_scene.generate_scene(height, width, bend=0.08, seed=8)
+    warped = process.process_image(frame, height, width)
+    _, curves, fits = lane.sliding_window(warped)
+    expected = reference_find_curve(warped, curves[0], curves[1])
+    result = lane.find_curve(warped, fits[0], fits[1])
+    print("curve radius reference {:.1f} / {:.1f} m, analytic {:.1f} / {:.1f} m".format(expected[0], expected[1], result[0], result[1]))
+    report("find_curve reference polyfit", *time_call(lambda: reference_find_curve(warped, curves[0], curves[1]), repeats))
+    report("find_curve analytic", *time_call(lambda: lane.find_curve(warped, fits[0], fits[1]), repeats))
+
+    # the same metrics for many streams at once
+    left_fits = np.repeat(fits[0][None], streams, axis=0)
+    right_fits = np.repeat(fits[1][None], streams, axis=0)
+    report("lane_metrics batch of {}".format(streams), *time_call(lambda: geometry.lane_metrics(left_fits, right_fits, height, width), repeats))
+    return check(np.allclose(result[:2], expected, rtol=1e-6), "analytic curve radius differs from the polyfit reference")
+
+
+#---bench_batch()----
+
+
+def bench_batch(height=720, width=1280, repeats=50, frames=16):
+    stack = np.stack([synthetic_scene.generate_scene(height, width, bend=0.1*np.sin(i), seed=i)[0] for i in range(frames)])
+    out = np.empty((frames, height, width), np.uint8)
+
+    def per_frame():
+        for frame in stack:
+            warped = process.process_image(frame, height, width)
+            fits = lane.sliding_window(warped)[2]
+            lane.find_curve(warped, fits[0], fits[1])
+
+    def batched():
+        lane.detect_batch(process.process_batch(stack, height, width, out=out))
+
+    trackers = [lane.LaneTracker() for _ in range(frames)]
+    def batched_tracking():
+        lane.detect_batch(process.process_batch(stack, height, width, out=out), trackers)
+
+    for name, func in (("per frame", per_frame), ("batched", batched), ("batched with trackers", batched_tracking)):
+        mean_ms, best_ms = time_call(func, max(repeats//frames, 3))
+        report("{} frames {} ({:.0f} FPS)".format(frames, name, 1000*frames/mean_ms), mean_ms, best_ms)
+
+
+#---bench_loop()----
+
+
+def bench_loop(height=720, width=1280, repeats=50):
+    # startup and per tick time of the whole single vehicle game loop, run headless
+    # against the carla stand-in with both cameras showing a fixed synthetic road
+    # so only detection and display are timed
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+    import fake_carla
+    import main as app
+    app.use_backend(fake_carla)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        world = app.init_world()
+        vehicle, bp_library = app.init_vehicle(world)
+        sensors = app.init_vehicle_sensors(world, vehicle, bp_library, width, height)
+        sensor, lane_sensor = [world.attach_source(SyntheticSource(width, height, lane_offset=lambda: 0.0)) for _ in range(2)]
+        startup_ms = (time.perf_counter() - start)*1000
+        loop_start = time.perf_counter()
+        app.game_loop(world, vehicle, sensor, lane_sensor, sensors[2], width, height, max_frames=repeats)
+        tick_ms = (time.perf_counter() - loop_start)*1000/repeats
+    report("game loop startup", startup_ms, startup_ms)
+    report("game loop per tick ({:.1f} FPS)".format(1000/tick_ms), tick_ms, tick_ms)
+
+
+#---bench_processes()----
+
+
+def bench_processes(height=360, width=640, repeats=50, streams=4, workers=2):
+    # lane detection throughput for several streams on the in-thread FramePipeline
+    # against the ProcessDetector's worker processes fed through shared memory.
+    # every frame is copied in once the way the sensor callbacks do it and both
+    # paths wait for a free buffer rather than drop frames, so they do the same work
+    import main as app
+    frames = [[synthetic_scene.generate_scene(height, width, bend=0.05*stream, dashed=(False, True),
+                                              lane_centre=0.5 + 0.05*np.sin(i/4.0), seed=stream)[0]
+               for i in range(8)] for stream in range(streams)]
+    slots = 2*streams
+
+    def run(submit, pool, delivered):
+        start = time.perf_counter()
+        for frame_id in range(repeats):
+            for stream in range(streams):
+                while pool.free == 0:
+                    time.sleep(0.0005)
+                buffer = pool.acquire()
+                np.copyto(buffer, frames[stream][frame_id % 8])
+                submit((frame_id, buffer, width, height, 1.0), stream)
+        while len(delivered) < repeats*streams:
+            time.sleep(0.0005)
+        return (time.perf_counter() - start)*1000
+
+    # in-thread: the stateless stage on worker threads, then each stream's tracker
+    # in submission order, streams spread over as many ordered threads
+    pool = ingest.BufferPool((height, width, 4), size=slots)
+    trackers = [lane.LaneTracker() for _ in range(streams)]
+    thread_results = []
+    def ordered(result):
+        stream, (frame_id, raw, img_, scale, _) = result
+        _, fits, _ = lane.track_scaled(trackers[stream], img_, height, width, scale)
+        pool.release(raw)
+        thread_results.append((stream, frame_id, fits))
+    pipeline = FramePipeline(lambda item: (item[0], app.lane_processing_stage(item[1])), ordered,
+                             workers=workers, maxsize=slots, on_drop=lambda item: pool.release(item[1][1]),
+                             ordered_workers=workers)
+    thread_ms = run(lambda frame, stream: pipeline.submit((stream, frame), stream), pool, thread_results)
+    pipeline.stop()
+
+    process_results = []
+    start = time.perf_counter()
+    detector = ProcessDetector((height, width, 4), lambda result: process_results.append(result[:2] + result[4:5]),
+                               workers=workers, slots=slots)
+    # warm the workers up so spawning them and importing cv2 isn't timed, on
+    # streams of their own to leave the timed streams' trackers untouched
+    for stream in range(streams):
+        buffer = detector.ring.acquire()
+        np.copyto(buffer, frames[stream][0])
+        detector.submit((-1, buffer, width, height, 1.0), streams + stream)
+    while len(process_results) < streams:
+        time.sleep(0.001)
+    startup_ms = (time.perf_counter() - start)*1000
+    process_results.clear()
+    process_ms = run(detector.submit, detector.ring, process_results)
+    detector.stop()
+
+    thread_fits = {(stream, frame_id): fits for stream, frame_id, fits in thread_results}
+    error = max(np.abs(np.asarray(fits) - thread_fits[stream, frame_id]).max() for stream, frame_id, fits in process_results)
+    total = repeats*streams
+    print("{} streams of {}x{}, {} workers, largest fit difference between the paths: {:.2e}".format(
+        streams, width, height, workers, error))
+    report("in-thread per frame ({:.1f} FPS)".format(1000*total/thread_ms), thread_ms/total, thread_ms/total)
+    report("processes per frame ({:.1f} FPS)".format(1000*total/process_ms), process_ms/total, process_ms/total)
+    report("process pool startup", startup_ms, startup_ms)
+    return check(len(process_results) == total and error <= 1e-9,
+                 "the worker processes' fits differ from the in-thread path by {:.2e}".format(error))
+
+
+#---record_fake_drive()----
+
+
+def record_fake_drive(path, frames=400, width=640, height=360, weave=0.25):
+    # drive one vehicle of the carla stand-in back and forth across its lane lines
+    # and record its lane camera along with the lane invasion sensor's events
+    import fake_carla
+    world = fake_carla.Client().load_world("Town05")
+    bp_library = world.get_blueprint_library()
+    vehicle = world.spawn_actor(bp_library.filter("model3")[0], fake_carla.Transform())
+    vehicle.weave = weave
+    camera_bp = bp_library.find("sensor.camera.rgb")
+    camera_bp.set_attribute("image_size_x", str(width))
+    camera_bp.set_attribute("image_size_y", str(height))
+    camera = world.spawn_actor(camera_bp, fake_carla.Transform(), attach_to=vehicle)
+    invasion = world.spawn_actor(bp_library.find("sensor.other.lane_invasion"), fake_carla.Transform(), attach_to=vehicle)
+
+    with FrameRecorder(path, width, height) as recorder:
+        camera.listen(lambda image: recorder.write(image.raw_data, image.frame, image.timestamp, vehicle.get_velocity().length()))
+        invasion.listen(lambda event: recorder.add_event(event.frame, event.timestamp,
+                                                         [marking.type for marking in event.crossed_lane_markings]))
+        for _ in range(frames):
+            world.tick()
+
+
+#---bench_departure()----
+
+
+def bench_departure(height=360, width=640, repeats=50, frames=400, horizon=3.0):
+    # replay a recorded drive through the tracker and departure predictor and
+    # compare the predicted warnings with the lane invasion sensor's events. a
+    # warning counts as ahead of an invasion if it came at most horizon seconds
+    # before it, warnings not followed by an invasion are counted as false
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, "drive.ldwrec")
+        record_fake_drive(path, frames, width, height)
+        replayer = FrameReplayer(path)
+        tracker = lane.LaneTracker(smoother=lane.LaneSmoother(eval_y=height - 1))
+        predictor = DeparturePredictor(height, width)
+        warnings = []
+        times = []
+        for index in range(len(replayer)):
+            meta = replayer.metadata(index)
+            img_ = process.process_image(replayer.frame(index), height, width)
+            detection = tracker.update(img_)
+            metrics = lane.find_curve(img_, *detection.lanes)
+            start = time.perf_counter()
+            prediction = predictor.update(meta["frame"], metrics, detection.lanes, meta["speed"])
+            times.append(time.perf_counter() - start)
+            if prediction.warn:
+                warnings.append(meta["timestamp"])
+        invasions = [event["timestamp"] for event in replayer.events]
+        del replayer
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    report("departure predictor update", np.mean(times)*1000, np.min(times)*1000)
+    leads = []
+    used = set()
+    for invasion in invasions:
+        ahead = [(invasion - warning, i) for i, warning in enumerate(warnings)
+                 if i not in used and 0 <= invasion - warning <= horizon]
+        if ahead:
+            lead, i = min(ahead)
+            leads.append(lead)
+            used.add(i)
+    false_warnings = len(warnings) - len(used)
+    print("{} invasions, {} warned ahead, {} false warnings".format(len(invasions), len(leads), false_warnings))
+    if leads:
+        print("warning lead time: mean {:.2f} s, min {:.2f} s, max {:.2f} s".format(np.mean(leads), np.min(leads), np.max(leads)))
+    return check(false_warnings == 0, "{} warnings not followed by an invasion".format(false_warnings))
+
+
+BENCHMARKS = {
+    "processes": bench_processes,
+    "departure": bench_departure,
+    "display": bench_display,
+    "loop": bench_loop,
+    "batch": bench_batch,
+    "curve": bench_find_curve,
+    "pipeline": bench_pipeline,
+    "ingest": bench_ingest,
+    "windows": bench_window_search,
+    "kernels": bench_kernels,
+    "seeding": bench_seeding,
+    "search": bench_lane_search,
+    "process": bench_process_image,
+    "threshold": bench_threshold_image,
+    "warp": bench_perspective_warp,
+}
+
+
+#---main()----
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the stages of the lane detection pipeline")
+    parser.add_argument("benchmarks", nargs="*", help="any of: " + ", ".join(sorted(BENCHMARKS)))
+    parser.add_argument("--repeats", type=int, default=50)
+    args = parser.parse_args()
+    unknown = [name for name in args.benchmarks if name not in BENCHMARKS]
+    if unknown:
+        parser.error("unknown benchmark: " + ", ".join(unknown))
+
+    # a benchmark that also checks its results returns False when they're wrong
+    print("lane kernels: {}".format(kernels.BACKEND))
+    failed = []
+    for name in args.benchmarks or sorted(BENCHMARKS):
+        print("---{}---".format(name))
+        if BENCHMARKS[name](repeats=args.repeats) is False:
+            failed.append(name)
+    if failed:
+        sys.exit("checks failed: " + ", ".join(failed))
+
+
+if __name__ == "__main__":
+    main()
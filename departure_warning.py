@@ -0,0 +1,106 @@
+import math
+
+import lane_geometry as geometry
+
+
+#---Prediction----
+
+
+class Prediction(object):
+    # outcome of one DeparturePredictor update. offset and distance are in metres,
+    # rate in metres per second towards side (-1 left, 1 right) and
+    # time_to_crossing in seconds, inf while the vehicle isn't heading for a line
+    __slots__ = ("frame", "offset", "rate", "side", "distance", "time_to_crossing", "warn")
+
+    def __init__(self, frame, offset, rate, side, distance, time_to_crossing, warn):
+        self.frame = frame
+        self.offset = offset
+        self.rate = rate
+        self.side = side
+        self.distance = distance
+        self.time_to_crossing = time_to_crossing
+        self.warn = warn
+
+    @property
+    def side_name(self):
+        return "right" if self.side > 0 else "left"
+
+
+#---DeparturePredictor----
+
+
+class DeparturePredictor(object):
+    # predict when the vehicle will cross a lane line from one camera stream's
+    # smoothed fits, so the warning can be raised before the lane invasion sensor
+    # fires. the lateral rate is an exponential average of the change in offset
+    # from the lane centre between frames. with heading_weight above 0 it is
+    # blended with the rate implied by the vehicle's speed and the slope of the
+    # lane at the bottom of the image, which reacts sooner but is only right if
+    # that slope follows the vehicle's yaw. below min_speed nothing warns. only
+    # the last offset and rate are kept, so every update is O(1). a warning is
+    # raised when the time to crossing drops below threshold seconds, while the
+    # line is still ahead: once it is crossed the lane invasion sensor reports
+    # it. the predictor only warns again once it has risen above rearm*threshold
+    def __init__(self, height=720, width=1280, threshold=1.0, frame_interval=0.05, alpha=0.3, heading_weight=0.0,
+                 min_speed=2.0, margin=0.0, rearm=1.5, max_gap=10):
+        self.height = height
+        self.width = width
+        self.threshold = threshold
+        self.frame_interval = frame_interval
+        self.alpha = alpha
+        self.heading_weight = heading_weight
+        self.min_speed = min_speed
+        self.margin = margin
+        self.rearm = rearm
+        self.max_gap = max_gap
+        self.warnings = 0
+        meters_pp_y, meters_pp_x = geometry.metres_per_pixel(height, width)
+        self._slope_scale = meters_pp_x/meters_pp_y
+        self.reset()
+
+    def reset(self):
+        self.rate = 0.0
+        self._last_frame = None
+        self._last_offset = None
+        self._armed = True
+
+    # metrics is the (left_r, right_r, dist_from_center, lane_width) tuple from
+    # find_curve, fits the (left, right) coefficients and speed the vehicle's
+    # speed in m/s, or None if it isn't known
+    def update(self, frame_id, metrics, fits, speed=None):
+        offset, lane_width = float(metrics[2]), float(metrics[3])
+
+        # measured rate from the change in offset since the last frame, forgotten
+        # if too many frames went by for the difference to mean anything
+        if self._last_frame is not None and 0 < frame_id - self._last_frame <= self.max_gap:
+            measured = (offset - self._last_offset)/((frame_id - self._last_frame)*self.frame_interval)
+            self.rate = self.alpha*measured + (1 - self.alpha)*self.rate
+        else:
+            self.rate = 0.0
+        self._last_frame = frame_id
+        self._last_offset = offset
+
+        # the lane centre's slope at the bottom of the image is the vehicle's heading
+        # relative to the lane, which at speed turns straight into a lateral rate
+        rate = self.rate
+        if speed is not None and self.heading_weight:
+            y = self.height - 1
+            slope = (2*fits[0][0]*y + fits[0][1] + 2*fits[1][0]*y + fits[1][1])/2
+            rate = (1 - self.heading_weight)*rate + self.heading_weight*speed*slope*self._slope_scale
+
+        side = 1 if rate >= 0 else -1
+        distance = lane_width/2 - side*offset - self.margin
+        if abs(rate) < 1e-3:
+            time_to_crossing = math.inf
+        else:
+            time_to_crossing = max(distance, 0.0)/abs(rate)
+
+        warn = False
+        if time_to_crossing < self.threshold:
+            if self._armed and distance > 0 and (speed is None or speed >= self.min_speed):
+                warn = True
+                self._armed = False
+                self.warnings += 1
+        elif time_to_crossing > self.threshold*self.rearm:
+            self._armed = True
+        return Prediction(frame_id, offset, abs(rate), side, distance, time_to_crossing, warn)
@@ -0,0 +1,351 @@
+import fnmatch
+import math
+from collections import OrderedDict
+
+from frame_recorder import ReplayImage
+from frame_source import SyntheticSource
+
+
+# a deterministic stand-in for the parts of the carla python api this project
+# uses, so the detection loop can run without the simulator or a gpu. vehicles
+# drive along a gently curving road, weaving across their lane, cameras render
+# that road with synthetic_scene on every world.tick() and lane invasion
+# sensors fire when a vehicle's centre crosses a lane line. any FrameSource can
+# be attached to a world to stand in for a camera
+
+
+#---basic types----
+
+
+class Vector3D(object):
+    def __init__(self, x=0.0, y=0.0, z=0.0):
+        self.x, self.y, self.z = x, y, z
+
+    def length(self):
+        return math.sqrt(self.x**2 + self.y**2 + self.z**2)
+
+
+class Location(Vector3D):
+    pass
+
+
+class Rotation(object):
+    def __init__(self, pitch=0.0, yaw=0.0, roll=0.0):
+        self.pitch, self.yaw, self.roll = pitch, yaw, roll
+
+
+class Transform(object):
+    def __init__(self, location=None, rotation=None):
+        self.location = location or Location()
+        self.rotation = rotation or Rotation()
+
+
+class VehicleControl(object):
+    def __init__(self, throttle=0.0, steer=0.0, brake=0.0, reverse=False, gear=0):
+        self.throttle, self.steer, self.brake = throttle, steer, brake
+        self.reverse, self.gear = reverse, gear
+
+
+class VehicleLightState(object):
+    NONE = 0
+    LeftBlinker = 1 << 5
+    RightBlinker = 1 << 4
+
+
+class WorldSettings(object):
+    def __init__(self):
+        self.synchronous_mode = False
+        self.fixed_delta_seconds = 0.05
+
+
+class LaneMarkingType(object):
+    def __init__(self, name):
+        self.name = name
+
+    def __str__(self):
+        return self.name
+
+
+class LaneMarking(object):
+    def __init__(self, marking_type):
+        self.type = marking_type
+
+
+#---sensor data----
+
+
+# the parts of carla.Image the callbacks use, raw_data is a bgra buffer
+Image = ReplayImage
+
+
+class LaneInvasionEvent(object):
+    def __init__(self, frame, timestamp, actor, crossed_lane_markings):
+        self.frame = frame
+        self.timestamp = timestamp
+        self.actor = actor
+        self.crossed_lane_markings = crossed_lane_markings
+
+
+#---blueprints----
+
+
+class ActorAttribute(object):
+    def __init__(self, value, recommended_values=()):
+        self.value = value
+        self.recommended_values = list(recommended_values)
+
+    def as_int(self):
+        return int(self.value)
+
+    def __str__(self):
+        return str(self.value)
+
+
+class ActorBlueprint(object):
+    def __init__(self, blueprint_id, attributes=None):
+        self.id = blueprint_id
+        self._attributes = OrderedDict((name, ActorAttribute(*value)) for name, value in (attributes or {}).items())
+
+    def has_attribute(self, name):
+        return name in self._attributes
+
+    def get_attribute(self, name):
+        return self._attributes[name]
+
+    def set_attribute(self, name, value):
+        recommended = self._attributes[name].recommended_values if name in self._attributes else ()
+        self._attributes[name] = ActorAttribute(value, recommended)
+
+
+class BlueprintLibrary(object):
+    def __init__(self):
+        self._blueprints = [
+            ActorBlueprint("vehicle.tesla.model3", {"colour": ("255,255,255", ["255,255,255", "200,0,0", "0,0,200"])}),
+            ActorBlueprint("sensor.camera.rgb", {"image_size_x": ("800",), "image_size_y": ("600",), "fov": ("90",)}),
+            ActorBlueprint("sensor.other.lane_invasion"),
+        ]
+
+    def filter(self, pattern):
+        if "*" not in pattern:
+            pattern = "*" + pattern + "*"
+        return [ActorBlueprint(bp.id, {name: (a.value, a.recommended_values) for name, a in bp._attributes.items()})
+                for bp in self._blueprints if fnmatch.fnmatch(bp.id, pattern)]
+
+    def find(self, blueprint_id):
+        matches = self.filter(blueprint_id)
+        if not matches:
+            raise IndexError("no blueprint %s" % blueprint_id)
+        return matches[0]
+
+
+#---actors----
+
+
+class Actor(object):
+    def __init__(self, world, actor_id, blueprint, transform, parent=None):
+        self.world = world
+        self.id = actor_id
+        self.type_id = blueprint.id
+        self.attributes = {name: attribute.value for name, attribute in blueprint._attributes.items()}
+        self.transform = transform
+        self.parent = parent
+        self.is_alive = True
+
+    def get_transform(self):
+        return self.transform
+
+    def destroy(self):
+        self.is_alive = False
+        self.world._remove(self)
+        return True
+
+
+class Vehicle(Actor):
+    # drives at a steady speed while its position in the lane follows a slow sine
+    # wave that takes it over the lane lines and back, offset by the steering
+    def __init__(self, world, actor_id, blueprint, transform, parent=None):
+        super().__init__(world, actor_id, blueprint, transform, parent)
+        self.speed = 8.0 + (actor_id % 5)
+        self.weave = 0.14 + 0.03*(actor_id % 4)
+        self.weave_period = 8.0 + 2*(actor_id % 3)
+        self.bend = 0.06*math.sin(actor_id)
+        self.light_state = VehicleLightState.NONE
+        self.autopilot = False
+        self.control = VehicleControl()
+        self._steer_offset = 0.0
+        self._time = 0.0
+
+    @property
+    def lane_offset(self):
+        # lateral position of the vehicle in fractions of the image width, 0 is the lane centre
+        return self.weave*math.sin(2*math.pi*self._time/self.weave_period + self.id) + self._steer_offset
+
+    def get_velocity(self):
+        return Vector3D(self.speed)
+
+    def apply_control(self, control):
+        self.control = control
+
+    def set_autopilot(self, enabled=True, port=8000):
+        self.autopilot = enabled
+
+    def set_light_state(self, light_state):
+        self.light_state = light_state
+
+    def get_light_state(self):
+        return self.light_state
+
+    def _step(self, dt):
+        self._time += dt
+        self._steer_offset += 0.02*self.control.steer*dt*self.speed/10
+
+
+class Sensor(Actor):
+    def __init__(self, world, actor_id, blueprint, transform, parent=None):
+        super().__init__(world, actor_id, blueprint, transform, parent)
+        self._callback = None
+
+    @property
+    def is_listening(self):
+        return self._callback is not None
+
+    def listen(self, callback):
+        self._callback = callback
+
+    def stop(self):
+        self._callback = None
+
+    def _emit(self, frame, timestamp):
+        pass
+
+
+class Camera(Sensor):
+    # renders the road in front of its vehicle at the vehicle's position in its lane
+    def __init__(self, world, actor_id, blueprint, transform, parent=None):
+        super().__init__(world, actor_id, blueprint, transform, parent)
+        self.width = int(self.attributes.get("image_size_x", 800))
+        self.height = int(self.attributes.get("image_size_y", 600))
+        lane_offset = (lambda: parent.lane_offset) if parent is not None else (lambda: 0.0)
+        self.source = SyntheticSource(self.width, self.height, parent.bend if parent is not None else 0.0,
+                                      lane_offset, seed=actor_id)
+
+    def _emit(self, frame, timestamp):
+        image = self.source.read()
+        self._callback(Image(image, self.width, self.height, frame, timestamp))
+
+
+class LaneInvasionSensor(Sensor):
+    # fires whenever the parent vehicle's centre moves across a lane line
+    def __init__(self, world, actor_id, blueprint, transform, parent=None):
+        super().__init__(world, actor_id, blueprint, transform, parent)
+        self._side = 0
+
+    def _emit(self, frame, timestamp):
+        offset = self.parent.lane_offset
+        half_lane = 0.2
+        side = -1 if offset < -half_lane else (1 if offset > half_lane else 0)
+        if side != self._side and side != 0:
+            marking = LaneMarking(LaneMarkingType("Broken" if side > 0 else "Solid"))
+            self._callback(LaneInvasionEvent(frame, timestamp, self.parent, [marking]))
+        self._side = side
+
+
+#---world----
+
+
+class Map(object):
+    def __init__(self, name):
+        self.name = name
+
+    def get_spawn_points(self):
+        return [Transform(Location(x=20.0*i, y=3.5*(i % 4), z=0.3), Rotation(yaw=90.0*(i % 4))) for i in range(16)]
+
+
+class World(object):
+    # advances vehicles and fires every listening sensor on each tick(), so in
+    # synchronous mode the callbacks run on the thread that calls tick()
+    def __init__(self, map_name="Town05"):
+        self.map = Map(map_name)
+        self.settings = WorldSettings()
+        self.frame = 0
+        self.elapsed_seconds = 0.0
+        self._blueprints = BlueprintLibrary()
+        self._actors = OrderedDict()
+        self._next_id = 1
+
+    def get_settings(self):
+        return self.settings
+
+    def apply_settings(self, settings):
+        self.settings = settings
+        return self.frame
+
+    def get_blueprint_library(self):
+        return self._blueprints
+
+    def get_map(self):
+        return self.map
+
+    def get_actors(self):
+        return list(self._actors.values())
+
+    # make a FrameSource tick with the world as if it were one of its cameras
+    def attach_source(self, source):
+        source.id = self._next_id
+        self._actors[source.id] = source
+        self._next_id += 1
+        return source
+
+    def spawn_actor(self, blueprint, transform, attach_to=None):
+        if blueprint.id.startswith("vehicle."):
+            actor_class = Vehicle
+        elif blueprint.id.startswith("sensor.camera."):
+            actor_class = Camera
+        elif blueprint.id == "sensor.other.lane_invasion":
+            actor_class = LaneInvasionSensor
+        else:
+            actor_class = Actor
+        actor = actor_class(self, self._next_id, blueprint, transform, attach_to)
+        self._actors[actor.id] = actor
+        self._next_id += 1
+        return actor
+
+    def tick(self, seconds=10.0):
+        dt = self.settings.fixed_delta_seconds or 0.05
+        self.frame += 1
+        self.elapsed_seconds += dt
+        actors = list(self._actors.values())
+        for actor in actors:
+            if isinstance(actor, Vehicle):
+                actor._step(dt)
+        for actor in actors:
+            if getattr(actor, "is_listening", False):
+                actor._emit(self.frame, self.elapsed_seconds)
+        return self.frame
+
+    def wait_for_tick(self, seconds=10.0):
+        return self.tick(seconds)
+
+    def _remove(self, actor):
+        self._actors.pop(actor.id, None)
+
+
+#---Client----
+
+
+class Client(object):
+    def __init__(self, host="localhost", port=2000):
+        self.host = host
+        self.port = port
+        self.timeout = None
+        self._world = World()
+
+    def set_timeout(self, seconds):
+        self.timeout = seconds
+
+    def get_world(self):
+        return self._world
+
+    def load_world(self, map_name):
+        self._world = World(map_name)
+        return self._world
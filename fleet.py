@@ -0,0 +1,353 @@
+import argparse
+import json
+import math
+import random
+import time
+from collections import OrderedDict
+
+import cv2
+import pygame
+import lane_detection as lane
+import lane_kernels as kernels
+import main
+from frame_pipeline import FramePipeline
+from frame_ingest import BufferPool, bgra_to_rgb, ingest_frame
+from instrumentation import StageStats, profiler
+from departure_warning import DeparturePredictor
+from renderer import Renderer
+
+
+#---FleetVehicle----
+
+
+class FleetVehicle(object):
+    # one ego vehicle of a fleet run: its sensors, its own lane tracker and
+    # smoother, its warning state and the latency of its frames from the sensor
+    # callback to the end of tracking
+    def __init__(self, index, vehicle, lane_sensor, lane_invasion_sensor, sensor_image_w, sensor_image_h, max_pending_frames=64):
+        self.index = index
+        self.stream = "vehicle %d" % index
+        self.vehicle = vehicle
+        self.lane_sensor = lane_sensor
+        self.lane_invasion_sensor = lane_invasion_sensor
+        self.sensor_image_w = sensor_image_w
+        self.sensor_image_h = sensor_image_h
+        self.tracker = lane.LaneTracker(smoother=lane.LaneSmoother(eval_y=sensor_image_h - 1))
+        self.predictor = DeparturePredictor(sensor_image_h, sensor_image_w)
+        self.max_pending_frames = max_pending_frames
+        self.latency = StageStats()
+
+        # warning state, the blinker flag matches ControlObject's so the departure
+        # logic is shared between the single vehicle loop and the fleet
+        self._blinker_active = False
+        self.warning_alpha = 0
+        self.invasions = 0
+        self.warnings = 0
+        self.predicted_warnings = 0
+
+        # latest results, read by the display
+        self.frames = 0
+        self.failures = 0
+        self.metrics = None
+        self.search = None
+        self._received = OrderedDict()
+
+    def frame_received(self, frame_id):
+        self._received[frame_id] = time.perf_counter()
+        while len(self._received) > self.max_pending_frames:
+            self._received.popitem(last=False)
+
+    def frame_done(self, frame_id):
+        received = self._received.pop(frame_id, None)
+        if received is not None:
+            self.latency.add((time.perf_counter() - received)*1000)
+
+    def frame_dropped(self, frame_id):
+        self._received.pop(frame_id, None)
+
+    def departure(self, event):
+        # count the crossing and raise the warning unless the driver signalled it
+        self.invasions += 1
+        if not self._blinker_active:
+            self.warnings += 1
+            self.warning_alpha = 255
+
+    def predicted_departure(self, prediction):
+        # same warning, raised by the departure predictor ahead of the crossing
+        if not self._blinker_active:
+            self.predicted_warnings += 1
+            self.warning_alpha = 255
+
+    def tick(self):
+        self.warning_alpha = max(self.warning_alpha - 2, 0)
+
+    def stats(self):
+        stats = OrderedDict([("vehicle", self.index), ("frames", self.frames), ("failures", self.failures),
+                             ("invasions", self.invasions), ("warnings", self.warnings),
+                             ("predicted_warnings", self.predicted_warnings)])
+        stats.update(("latency_" + name, value) for name, value in self.latency.summary().items() if name != "count")
+        stats["search"] = self.tracker.stats()
+        return stats
+
+    def stop(self):
+        for sensor in (self.lane_sensor, self.lane_invasion_sensor):
+            sensor.stop()
+
+
+#---fleet_processing_stage()----
+
+
+def fleet_processing_stage(frame):
+    # the stateless threshold and warp stage, tagged with the vehicle it belongs to
+    index, lane_frame = frame
+    return index, main.lane_processing_stage(lane_frame)
+
+
+#---fleet_tracking_stage()----
+
+
+def fleet_tracking_stage(result, vehicles, pool, tile_size=None):
+    # runs in submission order per vehicle, so each vehicle's tracker sees its own
+    # frames in sequence while other vehicles track theirs on the other ordered
+    # threads. with tile_size the lane overlay is drawn and shrunk to a grid
+    # tile, otherwise only the lane metrics are computed
+    index, (frame_id, raw, img_, _, _) = result
+    fleet_vehicle = vehicles[index]
+    tile = None
+    try:
+        with profiler.span("sliding_window"):
+            detection = fleet_vehicle.tracker.update(img_)
+        with profiler.span("find_curve"):
+            fleet_vehicle.metrics = lane.find_curve(img_, *detection.lanes)
+        with profiler.span("departure_predictor"):
+            prediction = fleet_vehicle.predictor.update(frame_id, fleet_vehicle.metrics, detection.lanes,
+                                                        fleet_vehicle.vehicle.get_velocity().length())
+        if prediction.warn:
+            fleet_vehicle.predicted_departure(prediction)
+        fleet_vehicle.search = detection.search
+        fleet_vehicle.frames += 1
+        if tile_size is not None:
+            with profiler.span("draw_lines"):
+                lanes = lane.draw_lines(bgra_to_rgb(raw), detection.lanes[0], detection.lanes[1],
+                                        fleet_vehicle.sensor_image_h, fleet_vehicle.sensor_image_w)
+                tile = cv2.resize(lanes, tile_size, interpolation=cv2.INTER_AREA)
+    except ValueError:
+        fleet_vehicle.failures += 1
+    finally:
+        pool.release(raw)
+    fleet_vehicle.frame_done(frame_id)
+    return index, frame_id, tile
+
+
+#---FleetDisplay----
+
+
+class FleetDisplay(object):
+    # tiled grid with one downscaled lane view per vehicle, a red frame while its
+    # departure warning is showing and a line of text with its lane metrics. only
+    # tiles with a new frame or a fading warning are drawn again
+    def __init__(self, count, tile_w, tile_h, columns=None):
+        columns = columns or int(math.ceil(math.sqrt(count)))
+        rows = int(math.ceil(count/float(columns)))
+        pygame.init()
+        self.font = pygame.font.SysFont("monospace", 14)
+        self.renderer = Renderer(tile_w, tile_h, columns, rows, caption="Lane departure warning fleet")
+        self.tiles = [self.renderer.add_pane("vehicle %d" % index) for index in range(count)]
+
+    def update(self, index, tile):
+        self.tiles[index].update(tile)
+
+    def draw(self, vehicles):
+        display = self.renderer.display
+        for fleet_vehicle, tile in zip(vehicles, self.tiles):
+            if fleet_vehicle.warning_alpha:
+                tile.invalidate()
+        rects = self.renderer.draw()
+        for fleet_vehicle, tile in zip(vehicles, self.tiles):
+            if tile.rect not in rects:
+                continue
+            if fleet_vehicle.warning_alpha:
+                red = int(fleet_vehicle.warning_alpha)
+                pygame.draw.rect(display, (red, 0, 0), tile.rect, 6)
+            text = fleet_vehicle.stream
+            if fleet_vehicle.metrics is not None:
+                text += "  {:+.2f} m".format(float(fleet_vehicle.metrics[2]))
+            display.blit(self.font.render(text, True, (255, 255, 255)), (tile.rect.x + 8, tile.rect.y + 8))
+        self.renderer.present(rects)
+
+    # True once the window has been closed
+    def closed(self):
+        return any(event.type == pygame.QUIT for event in pygame.event.get())
+
+    def close(self):
+        pygame.quit()
+
+
+#---spawn_fleet()----
+
+
+def spawn_fleet(world, count, sensor_image_w=1280, sensor_image_h=720):
+    # spawn count vehicles at distinct spawn points, each with its own lane
+    # camera and lane invasion sensor, and put them on autopilot
+    spawn_points = world.get_map().get_spawn_points()
+    if count > len(spawn_points):
+        raise ValueError("%d vehicles requested but the map only has %d spawn points" % (count, len(spawn_points)))
+    vehicles = []
+    for index, transform in enumerate(random.sample(spawn_points, count)):
+        vehicle, bp_library = main.init_vehicle(world, transform)
+        _, lane_sensor, lane_invasion_sensor = main.init_vehicle_sensors(world, vehicle, bp_library, sensor_image_w,
+                                                                         sensor_image_h, control_camera=False)
+        vehicle.set_autopilot(True)
+        vehicles.append(FleetVehicle(index, vehicle, lane_sensor, lane_invasion_sensor, sensor_image_w, sensor_image_h))
+    return vehicles
+
+
+#---fleet_loop()----
+
+
+def fleet_loop(world, vehicles, frames=None, workers=2, queue_size=4, render="grid", tile_width=320):
+    # drive the whole fleet from one loop: every camera feeds one shared pipeline
+    # whose workers threshold and warp frames from any vehicle, and the ordered
+    # stage hands each result to that vehicle's tracker. every vehicle is a stream
+    # of its own, so up to workers vehicles are tracked at once and a slow one
+    # only holds up the vehicles sharing its ordered thread. returns a summary
+    # with the fleet throughput and per vehicle latency
+    sensor_image_w, sensor_image_h = vehicles[0].sensor_image_w, vehicles[0].sensor_image_h
+    tile_size = None
+    display = None
+    if render == "grid":
+        tile_size = (tile_width, int(round(tile_width*sensor_image_h/float(sensor_image_w))))
+        display = FleetDisplay(len(vehicles), *tile_size)
+
+    # the queue grows with the fleet so one busy vehicle can't starve the others
+    queue_size = queue_size*len(vehicles)
+    pool = BufferPool((sensor_image_h, sensor_image_w, 4), size=queue_size + 2*workers)
+
+    def on_drop(frame):
+        index, (frame_id, raw, _, _, _) = frame
+        pool.release(raw)
+        vehicles[index].frame_dropped(frame_id)
+
+    pipeline = FramePipeline(fleet_processing_stage,
+        lambda result: fleet_tracking_stage(result, vehicles, pool, tile_size),
+        workers=workers, maxsize=queue_size, name="fleet", on_drop=on_drop,
+        ordered_workers=min(workers, len(vehicles)))
+
+    def listen(fleet_vehicle):
+        def lane_sensor_callback(image):
+            fleet_vehicle.frame_received(image.frame)
+            pipeline.submit((fleet_vehicle.index, (image.frame, ingest_frame(image, pool), sensor_image_w, sensor_image_h, 1.0)),
+                            fleet_vehicle.index)
+        fleet_vehicle.lane_sensor.listen(lane_sensor_callback)
+        fleet_vehicle.lane_invasion_sensor.listen(fleet_vehicle.departure)
+    for fleet_vehicle in vehicles:
+        listen(fleet_vehicle)
+
+    start = time.perf_counter()
+    ticks = 0
+    try:
+        while frames is None or ticks < frames:
+            world.tick()
+            ticks += 1
+
+            for index, frame_id, tile in pipeline.poll():
+                if display is not None and tile is not None:
+                    display.update(index, tile)
+            for fleet_vehicle in vehicles:
+                fleet_vehicle.tick()
+
+            if display is not None:
+                display.draw(vehicles)
+                if display.closed():
+                    break
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for fleet_vehicle in vehicles:
+            fleet_vehicle.stop()
+        pipeline.stop()
+        if display is not None:
+            display.close()
+    elapsed = time.perf_counter() - start
+
+    processed = sum(fleet_vehicle.frames for fleet_vehicle in vehicles)
+    return OrderedDict([
+        ("vehicles", len(vehicles)),
+        ("ticks", ticks),
+        ("elapsed_s", elapsed),
+        ("frames_processed", processed),
+        ("throughput_fps", processed/elapsed if elapsed > 0 else 0.0),
+        ("pipeline", pipeline.stats()),
+        ("lane_kernels", kernels.BACKEND),
+        ("buffer_allocations", pool.allocations),
+        ("per_vehicle", [fleet_vehicle.stats() for fleet_vehicle in vehicles]),
+    ])
+
+
+#---print_summary()----
+
+
+def print_summary(summary):
+    print("%d vehicles, %d ticks in %.2f s: %d frames processed (%.1f FPS across the fleet)" % (
+        summary["vehicles"], summary["ticks"], summary["elapsed_s"], summary["frames_processed"], summary["throughput_fps"]))
+    print("pipeline: %s, %s kernels" % (summary["pipeline"], summary["lane_kernels"]))
+    print("{:>7} {:>7} {:>8} {:>9} {:>9} {:>8} {:>8} {:>8}".format("vehicle", "frames", "failures", "warnings", "predicted",
+                                                                  "p50 ms", "p95 ms", "max ms"))
+    for stats in summary["per_vehicle"]:
+        print("{:>7} {:>7} {:>8} {:>9} {:>9} {:>8.1f} {:>8.1f} {:>8.1f}".format(
+            stats["vehicle"], stats["frames"], stats["failures"], stats["warnings"], stats["predicted_warnings"],
+            stats.get("latency_p50", float("nan")), stats.get("latency_p95", float("nan")), stats.get("latency_max", float("nan"))))
+
+
+#---parse_size()----
+
+
+def parse_size(text):
+    width, height = text.lower().split("x")
+    return int(width), int(height)
+
+
+#---fleet_main()----
+
+
+def fleet_main(argv=None):
+    parser = argparse.ArgumentParser(description="Run lane departure warning for several vehicles in one process")
+    parser.add_argument("-n", "--vehicles", type=int, default=4, help="number of ego vehicles to spawn")
+    parser.add_argument("--frames", type=int, help="stop after this many simulation ticks")
+    parser.add_argument("--workers", type=int, default=2, help="threads in the shared processing pool, and tracking threads")
+    parser.add_argument("--queue-size", type=int, default=4, help="queued frames per vehicle before the oldest are dropped")
+    parser.add_argument("--render", default="grid", choices=["grid", "none"], help="tiled grid of lane views, or run headless")
+    parser.add_argument("--tile-width", type=int, default=320, help="width of each grid tile in pixels")
+    parser.add_argument("--camera-size", type=parse_size, default=(1280, 720), help="WIDTHxHEIGHT of the lane cameras")
+    parser.add_argument("--fake", action="store_true", help="use the built in carla stand-in instead of a simulator")
+    parser.add_argument("--seed", type=int, default=0, help="seed for spawn point selection")
+    parser.add_argument("--report", metavar="PATH", help="write the summary to a json file")
+    parser.add_argument("--profile", action="store_true", help="record per stage timings as well")
+    args = parser.parse_args(argv)
+    profiler.enabled = args.profile
+    random.seed(args.seed)
+
+    if args.fake:
+        import fake_carla
+        main.use_backend(fake_carla)
+    world = main.init_world()
+    vehicles = spawn_fleet(world, args.vehicles, *args.camera_size)
+    try:
+        summary = fleet_loop(world, vehicles, args.frames, args.workers, args.queue_size, args.render, args.tile_width)
+    finally:
+        for fleet_vehicle in vehicles:
+            for actor in (fleet_vehicle.lane_sensor, fleet_vehicle.lane_invasion_sensor, fleet_vehicle.vehicle):
+                actor.destroy()
+    if args.profile:
+        summary["profile"] = profiler.summary()
+
+    print_summary(summary)
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(summary, f, indent=1, default=float)
+        print("summary written to %s" % args.report)
+    return summary
+
+
+if __name__ == "__main__":
+    fleet_main()
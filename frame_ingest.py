@@ -0,0 +1,108 @@
+import threading
+
+import numpy as np
+import cv2
+
+
+#---frame_view()----
+
+
+def frame_view(data):
+    # wrap the raw bgra sensor buffer without copying it. the view is only valid
+    # for as long as the sensor keeps the buffer alive, i.e. inside the callback
+    return np.frombuffer(data.raw_data, dtype=np.uint8).reshape((data.height, data.width, 4))
+
+
+#---BufferPool----
+
+
+class BufferPool(object):
+    # preallocated arrays of one shape that frames are copied into when they have
+    # to outlive the sensor callback. buffers go back into the pool with release(),
+    # and if the pool runs dry a new array is allocated and counted
+    def __init__(self, shape, dtype=np.uint8, size=8):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.size = size
+        self.allocations = 0
+        self._free = [np.empty(self.shape, self.dtype) for _ in range(size)]
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+            self.allocations += 1
+        return np.empty(self.shape, self.dtype)
+
+    @property
+    def free(self):
+        with self._lock:
+            return len(self._free)
+
+    def release(self, buffer):
+        if buffer is None or buffer.shape != self.shape or buffer.dtype != self.dtype:
+            return
+        with self._lock:
+            if len(self._free) < self.size:
+                self._free.append(buffer)
+
+
+#---ingest_frame()----
+
+
+def ingest_frame(data, pool=None):
+    # return the sensor frame as an (h, w, 4) bgra array, copied into a pooled
+    # buffer if a pool is given and otherwise as a zero-copy view of raw_data
+    view = frame_view(data)
+    if pool is None:
+        return view
+    buffer = pool.acquire()
+    np.copyto(buffer, view)
+    return buffer
+
+
+#---bgra_to_rgb()----
+
+
+_scratch = threading.local()
+
+
+def bgra_to_rgb(img, out=None):
+    # convert with a single cvtColor, into out or a per-thread scratch buffer that
+    # is overwritten by the next call on the same thread
+    if out is None:
+        buffers = getattr(_scratch, "buffers", None)
+        if buffers is None:
+            buffers = _scratch.buffers = {}
+        key = img.shape[:2]
+        if key not in buffers:
+            buffers[key] = np.empty(key + (3,), np.uint8)
+        out = buffers[key]
+    return cv2.cvtColor(img, cv2.COLOR_BGRA2RGB, dst=out)
+
+
+#---PersistentSurface----
+
+
+class PersistentSurface(object):
+    # a pygame surface that shares its memory with an (h, w, 3) rgb array, so
+    # frames are written straight into it instead of building a new surface each time
+    def __init__(self, width, height, pixels=None):
+        import pygame
+        self.pixels = np.empty((height, width, 3), np.uint8) if pixels is None else pixels
+        self.surface = pygame.image.frombuffer(self.pixels, (width, height), "RGB")
+
+    # copy a bgra, rgb or single channel image into the surface, single channel
+    # images are multiplied by scale first so binary images can be made visible
+    def update(self, img, bgr=False, scale=1):
+        if img.ndim == 2:
+            if scale != 1:
+                img = cv2.convertScaleAbs(img, alpha=scale)
+            cv2.cvtColor(img, cv2.COLOR_GRAY2RGB, dst=self.pixels)
+        elif img.shape[2] == 4:
+            cv2.cvtColor(img, cv2.COLOR_BGRA2RGB, dst=self.pixels)
+        elif bgr:
+            cv2.cvtColor(img, cv2.COLOR_BGR2RGB, dst=self.pixels)
+        else:
+            np.copyto(self.pixels, img)
@@ -0,0 +1,219 @@
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+
+
+#---FrameQueue----
+
+
+class FrameQueue(object):
+    # bounded queue of (sequence number, frame) pairs. putting into a full queue
+    # drops the oldest waiting frame so the workers always see the newest data
+    def __init__(self, maxsize=4):
+        self.maxsize = maxsize
+        self.dropped = 0
+        self._items = deque()
+        self._closed = False
+        self._condition = threading.Condition()
+
+    def __len__(self):
+        with self._condition:
+            return len(self._items)
+
+    # add an item and return the one it pushed out of the queue, if any
+    def put(self, item):
+        dropped = None
+        with self._condition:
+            if len(self._items) >= self.maxsize:
+                dropped = self._items.popleft()
+                self.dropped += 1
+            self._items.append(item)
+            self._condition.notify()
+        return dropped
+
+    # wait for the next item, returning None once the queue is closed and empty
+    def get(self, timeout=None):
+        with self._condition:
+            while not self._items and not self._closed:
+                if not self._condition.wait(timeout):
+                    return None
+            if not self._items:
+                return None
+            return self._items.popleft()
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+
+#---FramePipeline----
+
+
+class FramePipeline(object):
+    # move frame processing off the sensor callback threads. submit() only queues
+    # the frame, a pool of workers runs the stateless stage on it (OpenCV releases
+    # the GIL, so threads overlap well), and ordered_stage is then run on the
+    # results strictly in submission order, so state such as a lane tracker only
+    # ever sees frames in sequence. frames dropped from the full queue are skipped.
+    # with processes > 0 the workers hand the stage to a process pool instead,
+    # in which case stage must be a picklable top-level function. on_drop is
+    # called with every frame that is dropped or fails, e.g. to recycle its buffer.
+    # the ordered stage runs on threads of its own, outside the lock submit()
+    # and poll() take, so a slow ordered stage never holds up the callback.
+    # frames are numbered and ordered per stream, so with several streams, e.g.
+    # the cameras of a fleet, and ordered_workers > 1 the ordered stage runs for
+    # different streams at once. each stream is pinned to one ordered thread, so
+    # the stage never runs concurrently for the same stream
+    def __init__(self, stage, ordered_stage=None, workers=2, maxsize=4, processes=0, name="pipeline", on_drop=None,
+                 ordered_workers=1):
+        self.stage = stage
+        self.ordered_stage = ordered_stage
+        self.on_drop = on_drop
+        self.name = name
+        self.submitted = 0
+        self.processed = 0
+        self.delivered = 0
+        self.errors = 0
+        self.last_error = None
+
+        self._queue = FrameQueue(maxsize)
+        self._lock = threading.Lock()
+        self._ready = threading.Condition()
+        self._stopping = False
+        self._sequences = {}
+        self._streams = OrderedDict()
+        self._orderer_of = {}
+        self._results = deque()
+        self._process_pool = ProcessPoolExecutor(processes) if processes > 0 else None
+        self._workers = [threading.Thread(target=self._work, name="%s-worker-%d" % (name, i), daemon=True)
+                         for i in range(workers)]
+        for worker in self._workers:
+            worker.start()
+        self._orderers = [threading.Thread(target=self._order, args=(i,), name="%s-ordered-%d" % (name, i), daemon=True)
+                          for i in range(ordered_workers)]
+        for orderer in self._orderers:
+            orderer.start()
+
+    @property
+    def dropped(self):
+        return self._queue.dropped
+
+    def stats(self):
+        return {"submitted": self.submitted, "dropped": self.dropped, "processed": self.processed,
+                "delivered": self.delivered, "errors": self.errors, "queued": len(self._queue)}
+
+    # called from the sensor callback, only records the frame and returns its
+    # sequence number within the stream
+    def submit(self, frame, stream=0):
+        with self._lock:
+            sequence = self._sequences.get(stream, 0)
+            self._sequences[stream] = sequence + 1
+            self.submitted += 1
+        dropped = self._queue.put((stream, sequence, frame))
+        if dropped is not None:
+            self._discard(dropped[2])
+            self._finish(dropped[0], dropped[1], None, skipped=True)
+        return sequence
+
+    # return the results completed since the last poll, oldest first
+    def poll(self):
+        with self._lock:
+            results = list(self._results)
+            self._results.clear()
+        return results
+
+    def stop(self, timeout=1.0):
+        self._queue.close()
+        for worker in self._workers:
+            worker.join(timeout)
+        with self._ready:
+            self._stopping = True
+            self._ready.notify_all()
+        for orderer in self._orderers:
+            orderer.join(timeout)
+        if self._process_pool is not None:
+            self._process_pool.shutdown(wait=False)
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            stream, sequence, frame = item
+            try:
+                if self._process_pool is not None:
+                    result = self._process_pool.submit(self.stage, frame).result()
+                else:
+                    result = self.stage(frame)
+            except Exception as error:
+                self._record_error(error)
+                self._discard(frame)
+                self._finish(stream, sequence, None, skipped=True)
+                continue
+            self._finish(stream, sequence, result)
+
+    def _discard(self, frame):
+        if self.on_drop is not None:
+            self.on_drop(frame)
+
+    def _record_error(self, error):
+        with self._lock:
+            self.errors += 1
+            self.last_error = error
+
+    # store a result, or mark a dropped or failed frame as skipped, and wake the
+    # ordered stage threads. a stream's state is its next sequence number and
+    # its pending results and skipped sequence numbers
+    def _finish(self, stream, sequence, result, skipped=False):
+        with self._ready:
+            state = self._streams.get(stream)
+            if state is None:
+                state = self._streams[stream] = [0, {}, set()]
+                self._orderer_of[stream] = len(self._orderer_of) % len(self._orderers)
+            if skipped:
+                state[2].add(sequence)
+            else:
+                self.processed += 1
+                state[1][sequence] = result
+            self._ready.notify_all()
+
+    # the next result in sequence of any stream pinned to an ordered thread, or
+    # None. called with _ready held. a stream that gave a result goes to the back
+    # so a busy stream can't starve the others
+    def _next_result(self, orderer):
+        for stream, state in self._streams.items():
+            if self._orderer_of[stream] != orderer:
+                continue
+            while state[0] in state[2]:
+                state[2].remove(state[0])
+                state[0] += 1
+            if state[0] in state[1]:
+                result = state[1].pop(state[0])
+                state[0] += 1
+                self._streams.move_to_end(stream)
+                return (result,)
+        return None
+
+    # body of an ordered stage thread: take the results of its streams strictly
+    # in sequence and run the ordered stage on them with no lock held
+    def _order(self, orderer):
+        while True:
+            with self._ready:
+                while True:
+                    found = self._next_result(orderer)
+                    if found is not None:
+                        result = found[0]
+                        break
+                    if self._stopping:
+                        return
+                    self._ready.wait()
+            if self.ordered_stage is not None:
+                try:
+                    result = self.ordered_stage(result)
+                except Exception as error:
+                    self._record_error(error)
+                    continue
+            with self._lock:
+                self._results.append(result)
+                self.delivered += 1
@@ -0,0 +1,267 @@
+import json
+import queue
+import struct
+import threading
+import time
+import zlib
+from collections import deque
+
+import numpy as np
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+
+# a recording is a data file holding a fixed size header followed by chunks of
+# chunk_frames frames, each frame a fixed stride of height*width*4 bgra bytes,
+# and an index file next to it with one json line per chunk (offset, size,
+# compression and per frame metadata) and one per lane invasion event. chunks
+# are stored raw or compressed on their own, raw chunks are read back through
+# np.memmap without copying
+RECORDING_EXTENSION = ".ldwrec"
+MAGIC = b"LDWREC01"
+HEADER = struct.Struct("<8sIIII")
+
+
+#---available_compressions()----
+
+
+def available_compressions():
+    compressions = [None, "zlib"]
+    if lz4_frame is not None:
+        compressions.append("lz4")
+    return compressions
+
+
+def _compress(data, compression):
+    if compression == "zlib":
+        return zlib.compress(data, 1)
+    if compression == "lz4":
+        return lz4_frame.compress(data)
+    return data
+
+
+def _decompress(data, compression):
+    if compression == "zlib":
+        return zlib.decompress(data)
+    if compression == "lz4":
+        return lz4_frame.decompress(data)
+    return data
+
+
+def index_path(path):
+    return path + ".idx"
+
+
+#---FrameRecorder----
+
+
+class FrameRecorder(object):
+    # append bgra frames and their metadata to a recording. write() only copies
+    # the frame into a chunk buffer from a small pool, full chunks are handed to
+    # a writer thread through a bounded queue and compressed and written there,
+    # so the sensor callback never waits on zlib or the disk unless all buffers
+    # are still queued. events are only appended to a deque of their own, which
+    # the writer empties before each item it takes off the queue, so the lane
+    # invasion callback never waits either
+    def __init__(self, path, width, height, chunk_frames=32, compression=None, buffers=3):
+        if compression not in available_compressions():
+            raise ValueError("compression %r is not available, use one of %s" % (compression, available_compressions()))
+        self.path = path
+        self.width = width
+        self.height = height
+        self.chunk_frames = chunk_frames
+        self.compression = compression
+        self.frames_written = 0
+        self.bytes_written = 0
+
+        self._stride = height*width*4
+        self._free = queue.Queue()
+        for _ in range(buffers):
+            self._free.put(np.empty((chunk_frames, height, width, 4), np.uint8))
+        self._pending = queue.Queue(buffers)
+        self._events = deque()
+        self._chunk = self._free.get()
+        self._chunk_meta = []
+        self._lock = threading.Lock()
+        self._data = open(path, "wb")
+        self._index = open(index_path(path), "w")
+        self._data.write(HEADER.pack(MAGIC, 1, width, height, chunk_frames))
+        self._offset = HEADER.size
+        self._writer = threading.Thread(target=self._write, name="recorder-writer", daemon=True)
+        self._writer.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # add a frame, anything that exposes the buffer protocol with the right size
+    # is accepted, e.g. a carla.Image's raw_data or an (h, w, 4) array
+    def write(self, frame, frame_id, timestamp, speed=0.0, blinker=False):
+        frame = np.frombuffer(frame, dtype=np.uint8) if not isinstance(frame, np.ndarray) else frame
+        with self._lock:
+            slot = len(self._chunk_meta)
+            self._chunk[slot] = frame.reshape(self.height, self.width, 4)
+            self._chunk_meta.append([int(frame_id), float(timestamp), float(speed), bool(blinker)])
+            self.frames_written += 1
+            if len(self._chunk_meta) == self.chunk_frames:
+                self._queue_chunk()
+
+    # record lane invasion events, e.g. the crossed lane marking types
+    def add_event(self, frame_id, timestamp, markings):
+        line = json.dumps({"event": "lane_invasion", "frame": int(frame_id), "timestamp": float(timestamp),
+                           "markings": [str(marking) for marking in markings]})
+        self._events.append(line)
+
+    # queue the partly filled chunk and wait until the writer has written
+    # everything queued so far
+    def flush(self):
+        with self._lock:
+            if self._chunk_meta:
+                self._queue_chunk()
+        self._pending.put(("flush", None))
+        self._pending.join()
+
+    def close(self):
+        if self._data.closed:
+            return
+        self.flush()
+        self._pending.put(None)
+        self._writer.join()
+        self._data.close()
+        self._index.close()
+
+    # hand the current chunk to the writer and take an empty one from the pool
+    def _queue_chunk(self):
+        self._pending.put(("chunk", self._chunk, self._chunk_meta))
+        self._chunk = self._free.get()
+        self._chunk_meta = []
+
+    # body of the writer thread
+    def _write(self):
+        while True:
+            item = self._pending.get()
+            try:
+                while self._events:
+                    self._index.write(self._events.popleft() + "\n")
+                if item is None:
+                    return
+                if item[0] == "chunk":
+                    self._write_chunk(item[1], item[2])
+                    self._free.put(item[1])
+                else:
+                    self._data.flush()
+                    self._index.flush()
+            finally:
+                self._pending.task_done()
+
+    def _write_chunk(self, chunk, meta):
+        data = _compress(chunk[:len(meta)].tobytes(), self.compression)
+        self._data.write(data)
+        self._index.write(json.dumps({"offset": self._offset, "size": len(data), "compression": self.compression,
+                                      "frames": meta}) + "\n")
+        self._offset += len(data)
+        self.bytes_written += len(data)
+
+
+#---ReplayImage----
+
+
+class ReplayImage(object):
+    # the parts of carla.Image the sensor callbacks use
+    def __init__(self, raw_data, width, height, frame, timestamp):
+        self.raw_data = raw_data
+        self.width = width
+        self.height = height
+        self.frame = frame
+        self.timestamp = timestamp
+
+
+#---FrameReplayer----
+
+
+class FrameReplayer(object):
+    # random access and paced playback of a recording. frames of raw chunks are
+    # served as read-only views into a memory map of the data file, compressed
+    # chunks are decompressed on demand with the most recent chunk kept around
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            magic, version, self.width, self.height, self.chunk_frames = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError("%s is not a lane detection recording" % path)
+
+        self.chunks = []
+        self.events = []
+        self._locations = []
+        self._metadata = []
+        with open(index_path(path)) as f:
+            for line in f:
+                entry = json.loads(line)
+                if entry.get("event"):
+                    self.events.append(entry)
+                    continue
+                for slot, meta in enumerate(entry["frames"]):
+                    self._locations.append((len(self.chunks), slot))
+                    self._metadata.append(meta)
+                self.chunks.append(entry)
+
+        self._stride = self.height*self.width*4
+        self._mmap = np.memmap(path, dtype=np.uint8, mode="r") if self.chunks else None
+        self._cached_chunk = (None, None)
+
+    def __len__(self):
+        return len(self._locations)
+
+    # frame id, timestamp, vehicle speed and blinker state of a frame
+    def metadata(self, index):
+        frame_id, timestamp, speed, blinker = self._metadata[index]
+        return {"frame": frame_id, "timestamp": timestamp, "speed": speed, "blinker": blinker}
+
+    def events_for(self, frame_id):
+        return [event for event in self.events if event["frame"] == frame_id]
+
+    def frame(self, index):
+        chunk_index, slot = self._locations[index]
+        chunk = self.chunks[chunk_index]
+        if chunk["compression"] is None:
+            start = chunk["offset"] + slot*self._stride
+            data = self._mmap[start:start + self._stride]
+        else:
+            if self._cached_chunk[0] != chunk_index:
+                raw = self._mmap[chunk["offset"]:chunk["offset"] + chunk["size"]]
+                self._cached_chunk = (chunk_index, np.frombuffer(_decompress(raw.tobytes(), chunk["compression"]), np.uint8))
+            data = self._cached_chunk[1][slot*self._stride:(slot + 1)*self._stride]
+        return data.reshape(self.height, self.width, 4)
+
+    def image(self, index):
+        meta = self._metadata[index]
+        return ReplayImage(self.frame(index), self.width, self.height, meta[0], meta[1])
+
+    # yield ReplayImage objects, sleeping between them to follow the recorded
+    # timestamps at speed times real time when realtime is set
+    def images(self, start=0, stop=None, realtime=False, speed=1.0):
+        stop = len(self) if stop is None else min(stop, len(self))
+        first_timestamp = None
+        started = time.monotonic()
+        for index in range(start, stop):
+            image = self.image(index)
+            if realtime:
+                if first_timestamp is None:
+                    first_timestamp = image.timestamp
+                delay = (image.timestamp - first_timestamp)/speed - (time.monotonic() - started)
+                if delay > 0:
+                    time.sleep(delay)
+            yield image
+
+    # feed frames into a sensor callback such as main.lane_detection_callback
+    def replay(self, callback, start=0, stop=None, realtime=False, speed=1.0):
+        count = 0
+        for image in self.images(start, stop, realtime, speed):
+            callback(image)
+            count += 1
+        return count
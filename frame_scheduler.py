@@ -0,0 +1,98 @@
+import threading
+from collections import OrderedDict
+
+
+# detection levels from the most to the least work: the scale frames are resized
+# by before thresholding and how many frames are skipped after each detection
+DEFAULT_LEVELS = ((1.0, 0), (0.75, 0), (0.5, 0), (0.5, 1), (0.5, 2))
+
+
+#---FrameScheduler----
+
+
+class FrameScheduler(object):
+    # hold the lane detection of one stream within a per frame time budget. the
+    # cost of detecting a frame is tracked as an exponential average, divided by
+    # the frames each detection covers, and when it goes over budget_ms the
+    # scheduler moves down to the next level in levels, resizing frames further
+    # or skipping detection on some of them. it moves back up once the level
+    # above is expected to fit in headroom times the budget. after a change it
+    # waits settle detections before judging the new level
+    def __init__(self, budget_ms, levels=DEFAULT_LEVELS, alpha=0.2, headroom=0.8, settle=10):
+        self.budget_ms = budget_ms
+        self.levels = tuple(levels)
+        self.alpha = alpha
+        self.headroom = headroom
+        self.settle = settle
+        self.level = 0
+        self.cost_ms = None
+
+        # counters describing the decisions taken
+        self.frames = 0
+        self.detected = 0
+        self.skipped = 0
+        self.downgrades = 0
+        self.upgrades = 0
+
+        self._since_detection = 0
+        self._since_change = 0
+        self._lock = threading.Lock()
+
+    @property
+    def scale(self):
+        return self.levels[self.level][0]
+
+    @property
+    def skip(self):
+        return self.levels[self.level][1]
+
+    # decide what to do with the next frame: the scale to detect it at, or None
+    # to reuse the last fit for it
+    def next_frame(self):
+        with self._lock:
+            self.frames += 1
+            if self._since_detection < self.skip:
+                self._since_detection += 1
+                self.skipped += 1
+                return None
+            self._since_detection = 0
+            self.detected += 1
+            return self.scale
+
+    # report how long detecting a frame at scale took, frames detected at another
+    # scale before a change are ignored
+    def record(self, ms, scale):
+        with self._lock:
+            if scale != self.scale:
+                return
+            self.cost_ms = ms if self.cost_ms is None else self.alpha*ms + (1 - self.alpha)*self.cost_ms
+            self._since_change += 1
+            if self._since_change < self.settle:
+                return
+
+            if self._frame_cost(self.level) > self.budget_ms and self.level < len(self.levels) - 1:
+                self._change(self.level + 1)
+                self.downgrades += 1
+            elif self.level > 0 and self._frame_cost(self.level - 1) < self.headroom*self.budget_ms:
+                self._change(self.level - 1)
+                self.upgrades += 1
+
+    # expected time per frame at a level, from the measured cost at the current
+    # one assuming detection time goes with the number of pixels
+    def _frame_cost(self, level):
+        scale, skip = self.levels[level]
+        detection_ms = self.cost_ms*(scale/self.scale)**2
+        return detection_ms/(skip + 1)
+
+    def _change(self, level):
+        self.cost_ms *= (self.levels[level][0]/self.scale)**2
+        self.level = level
+        self._since_change = 0
+
+    def stats(self):
+        with self._lock:
+            frame_ms = self._frame_cost(self.level) if self.cost_ms is not None else None
+            return OrderedDict([("level", self.level), ("scale", self.scale), ("skip", self.skip),
+                                ("detection_ms", self.cost_ms), ("frame_ms", frame_ms), ("budget_ms", self.budget_ms),
+                                ("frames", self.frames), ("detected", self.detected), ("skipped", self.skipped),
+                                ("downgrades", self.downgrades), ("upgrades", self.upgrades)])
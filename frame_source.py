@@ -0,0 +1,243 @@
+import math
+import os
+from collections import OrderedDict
+
+import numpy as np
+import cv2
+import synthetic_scene
+from frame_recorder import RECORDING_EXTENSION, FrameReplayer, ReplayImage
+
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp")
+VIDEO_EXTENSIONS = (".mp4", ".avi", ".mov", ".mkv")
+
+
+# frame sources look like a carla camera sensor to the code that listens to
+# them: listen(callback) registers the callback, which is then given an object
+# with raw_data, width, height, frame and timestamp for every bgra frame. a
+# world calls _emit() on each listening source once per tick, so file and
+# synthetic sources are driven by the same tick() as the simulator's cameras
+
+
+#---FrameSource----
+
+
+class FrameSource(object):
+    # base class of the frame sources, subclasses implement read() to return the
+    # next (height, width, 4) bgra frame or None once they have run out
+    type_id = "source"
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.frames_emitted = 0
+        self.exhausted = False
+        self.is_alive = True
+        self._callback = None
+
+    @property
+    def is_listening(self):
+        return self._callback is not None
+
+    def listen(self, callback):
+        self._callback = callback
+
+    def stop(self):
+        self._callback = None
+
+    def destroy(self):
+        self.stop()
+        self.is_alive = False
+        return True
+
+    def read(self):
+        raise NotImplementedError
+
+    def _emit(self, frame, timestamp):
+        if self.exhausted:
+            return
+        img = self.read()
+        if img is None:
+            self.exhausted = True
+            return
+        self.frames_emitted += 1
+        self._callback(ReplayImage(img, self.width, self.height, frame, timestamp))
+
+
+#---CarlaSensorSource----
+
+
+class CarlaSensorSource(FrameSource):
+    # a simulator camera, which pushes its own frames on every world tick so the
+    # source only passes listen() and stop() through to it, counting the frames
+    def __init__(self, sensor):
+        super().__init__(int(sensor.attributes["image_size_x"]), int(sensor.attributes["image_size_y"]))
+        self.sensor = sensor
+        self.type_id = sensor.type_id
+
+    def listen(self, callback):
+        super().listen(callback)
+        self.sensor.listen(lambda image: self._forward(image, callback))
+
+    def _forward(self, image, callback):
+        self.frames_emitted += 1
+        callback(image)
+
+    def stop(self):
+        super().stop()
+        self.sensor.stop()
+
+    def destroy(self):
+        self.stop()
+        self.is_alive = False
+        return self.sensor.destroy()
+
+    def _emit(self, frame, timestamp):
+        pass
+
+
+#---IteratorSource----
+
+
+class IteratorSource(FrameSource):
+    # frames from an iterable of (index, frame) pairs such as the ones
+    # frame_reader() makes. bgr frames are converted to bgra, and with loop the
+    # iterable is made again by make_frames() when it runs out
+    def __init__(self, make_frames, loop=False):
+        self.make_frames = make_frames
+        self.loop = loop
+        self._frames = iter(make_frames())
+        self._first = self._next_frame()
+        if self._first is None:
+            raise ValueError("frame source is empty")
+        super().__init__(self._first.shape[1], self._first.shape[0])
+        self._bgra = np.empty((self.height, self.width, 4), np.uint8)
+
+    def _next_frame(self):
+        for _, frame in self._frames:
+            return frame
+        return None
+
+    def read(self):
+        if self._first is not None:
+            frame, self._first = self._first, None
+        else:
+            frame = self._next_frame()
+            if frame is None and self.loop:
+                self._frames = iter(self.make_frames())
+                frame = self._next_frame()
+            if frame is None:
+                return None
+        if frame.ndim == 3 and frame.shape[2] == 4:
+            return np.ascontiguousarray(frame)
+        code = cv2.COLOR_GRAY2BGRA if frame.ndim == 2 else cv2.COLOR_BGR2BGRA
+        return cv2.cvtColor(frame, code, dst=self._bgra)
+
+
+#---frame_reader()----
+
+
+def _directory_frames(path):
+    names = sorted(name for name in os.listdir(path) if name.lower().endswith(IMAGE_EXTENSIONS))
+    for index, name in enumerate(names):
+        frame = cv2.imread(os.path.join(path, name), cv2.IMREAD_COLOR)
+        if frame is not None:
+            yield index, frame
+
+
+def _video_frames(path):
+    capture = cv2.VideoCapture(path)
+    try:
+        index = 0
+        while True:
+            ok, frame = capture.read()
+            if not ok:
+                return
+            yield index, frame
+            index += 1
+    finally:
+        capture.release()
+
+
+def _recording_frames(path):
+    # served from the recording's memory map
+    replayer = FrameReplayer(path)
+    for index in range(len(replayer)):
+        yield index, replayer.frame(index)
+
+
+def _stack_frames(path):
+    frames = np.load(path, mmap_mode="r")
+    for index in range(frames.shape[0]):
+        yield index, np.asarray(frames[index])
+
+
+def _raw_frames(path, width, height):
+    frames = np.memmap(path, dtype=np.uint8, mode="r")
+    frames = frames[:frames.size - frames.size % (height*width*4)].reshape((-1, height, width, 4))
+    for index in range(frames.shape[0]):
+        yield index, np.asarray(frames[index])
+
+
+def frame_reader(path, raw_size=None):
+    # return a function making an iterator of (index, frame) pairs from a
+    # directory of images, a video file, a .npy stack of frames, a recording made
+    # with --record or a raw dump of bgra frames of raw_size (width, height).
+    # images and video frames are bgr, the others bgra. the one reader behind
+    # both open_source and lane_detection_batch
+    if os.path.isdir(path):
+        return lambda: _directory_frames(path)
+    lower = path.lower()
+    if lower.endswith(VIDEO_EXTENSIONS):
+        return lambda: _video_frames(path)
+    if lower.endswith(RECORDING_EXTENSION):
+        return lambda: _recording_frames(path)
+    if lower.endswith(".npy"):
+        return lambda: _stack_frames(path)
+    if raw_size is None:
+        raise ValueError("don't know how to read frames from %s, raw bgra dumps need their frame size" % path)
+    return lambda: _raw_frames(path, *raw_size)
+
+
+#---SyntheticSource----
+
+
+class SyntheticSource(FrameSource):
+    # endless synthetic road frames from synthetic_scene. the camera's position in
+    # its lane comes from lane_offset(), a function returning the offset in
+    # fractions of the image width, or by default follows a slow deterministic
+    # weave. rendered frames are cached by their rounded offset
+    def __init__(self, width=1280, height=720, bend=0.0, lane_offset=None, seed=0, noise=10, cache_size=64):
+        super().__init__(width, height)
+        self.bend = bend
+        self.lane_offset = lane_offset if lane_offset is not None else self._weave
+        self.seed = seed
+        self.noise = noise
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+
+    def _weave(self):
+        return 0.1*math.sin(2*math.pi*self.frames_emitted/200.0)
+
+    def read(self):
+        key = round(self.lane_offset(), 3)
+        frame = self._cache.get(key)
+        if frame is None:
+            frame, _ = synthetic_scene.generate_scene(self.height, self.width, bend=self.bend, dashed=(False, True),
+                                                      noise=self.noise, lane_centre=0.5 - key, seed=self.seed)
+            self._cache[key] = frame
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        else:
+            self._cache.move_to_end(key)
+        return frame
+
+
+#---open_source()----
+
+
+def open_source(spec, width=1280, height=720, loop=False, raw_size=None):
+    # pick a source from a path or "synthetic", any path frame_reader() reads
+    if spec == "synthetic":
+        return SyntheticSource(width, height)
+    return IteratorSource(frame_reader(spec, raw_size), loop)
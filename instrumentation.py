@@ -0,0 +1,168 @@
+import csv
+import json
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+#---StageStats----
+
+
+class StageStats(object):
+    # rolling latency samples of one stage in milliseconds, kept in a fixed ring
+    # so recording is O(1) and percentiles cover the most recent window samples
+    def __init__(self, window=1024):
+        self.window = window
+        self.samples = np.zeros(window)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, ms):
+        self.samples[self.count % self.window] = ms
+        self.count += 1
+        self.total += ms
+        if ms > self.max:
+            self.max = ms
+
+    def summary(self):
+        recent = self.samples[:min(self.count, self.window)]
+        if not len(recent):
+            return {"count": 0}
+        p50, p95, p99 = np.percentile(recent, [50, 95, 99])
+        return {"count": self.count, "mean": self.total/self.count, "p50": float(p50),
+                "p95": float(p95), "p99": float(p99), "max": self.max}
+
+
+#---Span----
+
+
+class _NullSpan(object):
+    # returned by Profiler.span while profiling is off so timing costs nothing
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_SPAN = _NullSpan()
+
+
+class Span(object):
+    __slots__ = ("profiler", "name", "start")
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.record(self.name, (time.perf_counter() - self.start)*1000)
+        return False
+
+
+#---Profiler----
+
+
+class Profiler(object):
+    # per stage latency spans, counters and the latency of frames from the sensor
+    # callback to the display, that can be switched on and off at runtime. while
+    # disabled span() hands back a shared no-op context manager and nothing is
+    # recorded
+    def __init__(self, enabled=False, window=1024, max_pending_frames=256):
+        self.enabled = enabled
+        self.window = window
+        self.max_pending_frames = max_pending_frames
+        self.stages = OrderedDict()
+        self.counters = OrderedDict()
+        self._pending_frames = OrderedDict()
+        self._lock = threading.Lock()
+
+    def span(self, name):
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name)
+
+    def record(self, name, ms):
+        with self._lock:
+            stats = self.stages.get(name)
+            if stats is None:
+                stats = self.stages[name] = StageStats(self.window)
+            stats.add(ms)
+
+    def count(self, name, n=1):
+        if self.enabled:
+            with self._lock:
+                self.counters[name] = self.counters.get(name, 0) + n
+
+    def set_counter(self, name, value):
+        if self.enabled:
+            with self._lock:
+                self.counters[name] = value
+
+    # note when the sensor callback gets a frame so its latency to the screen can
+    # be measured. this is callback to display latency: the time the frame spent
+    # in the simulator and the client library before the callback isn't included
+    def frame_received(self, stream, frame_id):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._pending_frames[(stream, frame_id)] = time.perf_counter()
+            while len(self._pending_frames) > self.max_pending_frames:
+                self._pending_frames.popitem(last=False)
+
+    def frame_displayed(self, stream, frame_id):
+        if not self.enabled:
+            return
+        with self._lock:
+            received = self._pending_frames.pop((stream, frame_id), None)
+        if received is not None:
+            self.record(stream + " callback_to_display", (time.perf_counter() - received)*1000)
+
+    def reset(self):
+        with self._lock:
+            self.stages.clear()
+            self.counters.clear()
+            self._pending_frames.clear()
+
+    def summary(self):
+        with self._lock:
+            return {"stages": OrderedDict((name, stats.summary()) for name, stats in self.stages.items()),
+                    "counters": OrderedDict(self.counters)}
+
+    # short text lines for an on-screen display
+    def hud_lines(self):
+        summary = self.summary()
+        lines = ["{:<28} {:>7} {:>7} {:>7}".format("stage (ms)", "p50", "p95", "p99")]
+        for name, stats in summary["stages"].items():
+            if stats["count"]:
+                lines.append("{:<28} {:7.2f} {:7.2f} {:7.2f}".format(name[:28], stats["p50"], stats["p95"], stats["p99"]))
+        for name, value in summary["counters"].items():
+            lines.append("{:<28} {:>7}".format(name[:28], value))
+        return lines
+
+    # write the summary to json, or to csv if the path ends in .csv
+    def dump(self, path):
+        summary = self.summary()
+        if path.lower().endswith(".csv"):
+            fields = ["stage", "count", "mean", "p50", "p95", "p99", "max"]
+            with open(path, "w", newline="") as f:
+                writer = csv.DictWriter(f, fieldnames=fields)
+                writer.writeheader()
+                for name, stats in summary["stages"].items():
+                    writer.writerow(dict(stats, stage=name))
+                for name, value in summary["counters"].items():
+                    writer.writerow({"stage": name, "count": value})
+        else:
+            with open(path, "w") as f:
+                json.dump(summary, f, indent=1)
+
+
+# profiler shared by the pipeline stages, off until something enables it
+profiler = Profiler()
@@ -1,5 +1,8 @@
 import numpy as np
 import process_image as process
+import lane_geometry as geometry
+import lane_kernels as kernels
+from instrumentation import profiler
 import cv2
 
 
@@ -11,151 +14,553 @@ def histogram_values(img):
     hist = np.sum(img[img.shape[0]//2:,:], axis=0)
     return hist
 
-# initialise lane line polynomial coeeficient lists
-left1, left2, left3 = [], [], []
-right1, right2, right3 = [], [], []
 
+#---column_histogram()----
 
-#---sliding_window()----
+
+def column_histogram(img, column_step=8):
+    # count the lane pixels of the bottom half of the image in bins of column_step
+    # columns. cv2.reduce sums the rows in one pass without widening every pixel
+    # the way np.sum does, and the bins cut the peak search to a fraction of the
+    # columns
+    columns = cv2.reduce(img[img.shape[0]//2:], 0, cv2.REDUCE_SUM, dtype=cv2.CV_32S)[0]
+    return np.add.reduceat(columns, np.arange(0, len(columns), column_step))
+
+
+#---histogram_lines()----
+
+
+def histogram_lines(histogram, column_step=8, min_separation=160, min_share=0.25):
+    # x positions of every lane line in a column histogram, left to right. peaks
+    # of the lightly smoothed histogram holding at least min_share of the highest
+    # one are kept, strongest first, unless a stronger peak is already within
+    # min_separation pixels. each is refined to sub-pixel accuracy by fitting a
+    # parabola through its bin and the two either side
+    smoothed = np.convolve(histogram, (1, 2, 1), "same").astype(np.float64)
+    centre = smoothed[1:-1]
+    is_peak = (centre >= smoothed[:-2]) & (centre > smoothed[2:]) & (centre >= min_share*smoothed.max()) & (centre > 0)
+    candidates = np.nonzero(is_peak)[0] + 1
+    candidates = candidates[np.argsort(-smoothed[candidates], kind="stable")]
+
+    peaks = []
+    for index in candidates:
+        if all(abs(int(index) - other)*column_step >= min_separation for other in peaks):
+            peaks.append(int(index))
+    peaks.sort()
+
+    positions = np.empty(len(peaks))
+    for i, index in enumerate(peaks):
+        left, middle, right = smoothed[index - 1], smoothed[index], smoothed[index + 1]
+        curvature = left - 2*middle + right
+        offset = 0.5*(left - right)/curvature if curvature < 0 else 0.0
+        positions[i] = (index + offset + 0.5)*column_step - 0.5
+    return positions
+
+
+#---lane_bases()----
+
+
+def lane_bases(img, column_step=8, min_separation=0.125):
+    # starting columns of every lane line visible in the bottom half of a warped
+    # binary image, and the indices of the two lines the camera sits between.
+    # min_separation is a fraction of the image width
+    return histogram_bases(column_histogram(img, column_step), img.shape[1], column_step, min_separation)
+
+
+#---batch_lane_bases()----
 
 
-def sliding_window(img):
-    num_windows = 9
-    margin = 150
-    minpix = 1
-    left_fit_ = np.empty(3)
-    right_fit_ = np.empty(3)
-    output_windows = np.dstack((img, img, img))*255
+def batch_lane_bases(imgs, column_step=8, min_separation=0.125):
+    # lane_bases for an (N, H, W) stack of images, the column histograms of the
+    # whole stack binned in one go. returns a (positions, ego) pair per image
+    height, width = imgs.shape[1:3]
+    columns = np.sum(imgs[:, height//2:], axis=1, dtype=np.int32)
+    histograms = np.add.reduceat(columns, np.arange(0, width, column_step), axis=1)
+    return [histogram_bases(histogram, width, column_step, min_separation) for histogram in histograms]
 
-    # calculate histogram peaks of image halves
-    histogram = histogram_values(img)
-    midpoint = int(histogram.shape[0]/2)
-    leftx_initial = np.argmax(histogram[:midpoint])
-    rightx_initial = np.argmax(histogram[midpoint:]) + midpoint
+
+#---histogram_bases()----
+
+
+def histogram_bases(histogram, width, column_step=8, min_separation=0.125):
+    # the lines of a binned column histogram of an image width pixels wide and
+    # the indices of the ego lane's two, as lane_bases returns them
+    positions = histogram_lines(histogram, column_step, min_separation*width)
+
+    # the camera is at the centre of the image, so the ego lane lies between the
+    # last line left of it and the first right of it. if every line is on one
+    # side take the two nearest, and with fewer than two lines fall back to the
+    # highest bins of either half
+    if len(positions) < 2:
+        midpoint = len(histogram)//2
+        left = np.argmax(histogram[:midpoint])
+        right = np.argmax(histogram[midpoint:]) + midpoint
+        return (np.array([left, right]) + 0.5)*column_step - 0.5, (0, 1)
+    right = int(np.searchsorted(positions, width/2))
+    right = min(max(right, 1), len(positions) - 1)
+    return positions, (right - 1, right)
+
+
+#---window_search_lines()----
+
+
+def window_search_lines(img, num_windows=9, margin=150, minpix=1, bases=None, ego=(0, 1)):
+    # sliding window search for any number of lane lines. without bases every line
+    # seeded by lane_bases is followed, otherwise the lines start at the given
+    # columns and ego picks the two of them bounding the ego lane. returns the
+    # (x, y) pixels of each line, the indices of the ego lane's two lines and the
+    # window borders for the debug image
+    if bases is None:
+        bases, ego = lane_bases(img)
 
     # set height of sliding window
-    window_height = np.int(img.shape[0]/num_windows)
-
-    # get x and y location of all non-zero pixels in the image
-    nonzero = img.nonzero()
-    nonzero_y = np.array(nonzero[0])
-    nonzero_x = np.array(nonzero[1])
-
-    # set current left and right peaks to initial peaks
-    leftx_current = leftx_initial
-    rightx_current = rightx_initial
-
-    # empty arrays to store pixel indices of lane lines
-    left_lane_indices = []
-    right_lane_indices = []
-
-    # sliding window loop
-    for window in range(num_windows):
-        # define borders for sliding window
-        window_low_y = img.shape[0] - (window+1) * window_height
-        window_high_y = img.shape[0] - window * window_height
-        window_left_low_x = leftx_current - margin
-        window_left_high_x = leftx_current + margin
-        window_right_low_x = rightx_current - margin
-        window_right_high_x = rightx_current + margin
-
-        # add boxes showing the sliding windows to an output image
-        cv2.rectangle(output_windows,(window_left_low_x, window_low_y),(window_left_high_x, window_high_y), (100,255,255), 3) 
-        cv2.rectangle(output_windows,(window_right_low_x, window_low_y),(window_right_high_x, window_high_y), (100,255,255), 3)
-
-        # identify nonzero pixels in each window
-        nonzero_left_indices = ((nonzero_y >= window_low_y) & (nonzero_y < window_high_y) & 
-        (nonzero_x >= window_left_low_x) & (nonzero_x < window_left_high_x)).nonzero()[0]
-        nonzero_right_indices = ((nonzero_y >= window_low_y) & (nonzero_y < window_high_y) & 
-        (nonzero_x >= window_right_low_x) & (nonzero_x < window_right_high_x)).nonzero()[0]
-
-        # append nonzero pixels to lane indices lists
-        left_lane_indices.append(nonzero_left_indices)
-        right_lane_indices.append(nonzero_right_indices)
-
-        # if number of pixels idnetified > minipix then recenter window at mean position
-        if len(nonzero_left_indices) > minpix:
-            leftx_current = np.int(np.mean(nonzero_x[nonzero_left_indices]))
-        if len(nonzero_right_indices) > minpix:
-            rightx_current = np.int(np.mean(nonzero_x[nonzero_right_indices]))
-        
-    # concatenate indices lists to update lane indices
-    left_lane_indices = np.concatenate(left_lane_indices)
-    right_lane_indices = np.concatenate(right_lane_indices)
-
-    # retrieve left and right line pixel positions
-    left_x = nonzero_x[left_lane_indices]
-    left_y = nonzero_y[left_lane_indices]
-    right_x = nonzero_x[right_lane_indices]
-    right_y = nonzero_y[right_lane_indices]
+    window_height = int(img.shape[0]/num_windows)
+
+    # x and y location of all non-zero pixels in the image. nonzero() returns
+    # them in row order, so the pixels of each window's row band are a contiguous
+    # slice and each window only has to look at its own band
+    nonzero_y, nonzero_x = img.nonzero()
+    band_edges = img.shape[0] - np.arange(num_windows + 1)*window_height
+    band_starts = np.searchsorted(nonzero_y, band_edges, side="left")
+
+    # follow every line up the bands, in compiled loops if numba is installed
+    centres, indices, offsets = kernels.window_scan(nonzero_x, band_starts, bases, margin, minpix)
+
+    # keep the window borders so they can be drawn if a debug image is wanted
+    windows = [(band_edges[window+1], band_edges[window]) + tuple(int(x) - margin for x in centres[window])
+               for window in range(num_windows)]
+
+    # retrieve the pixel positions of each line
+    pixels = []
+    for line in range(len(bases)):
+        line_indices = indices[offsets[line]:offsets[line+1]]
+        pixels.append((nonzero_x[line_indices], nonzero_y[line_indices]))
+    return pixels, ego, (windows, margin)
+
+
+#---window_search()----
+
+
+def window_search(img, num_windows=9, margin=150, minpix=1, bases=None):
+    # sliding window search for the two lines of the ego lane only
+    pixels, ego, windows = window_search_lines(img, num_windows, margin, minpix, bases)
+    return pixels[ego[0]], pixels[ego[1]], windows
+
+
+#---fit_search()----
+
+
+def fit_search(img, fit, margin=100):
+    # collect the nonzero pixels within margin of a previous polynomial fit,
+    # only looking at the columns the search band can reach
+    polyline = np.arange(img.shape[0])
+    fit_x = fit[0]*polyline**2 + fit[1]*polyline + fit[2]
+    low_x = int(max(np.min(fit_x) - margin, 0))
+    high_x = int(min(np.max(fit_x) + margin + 1, img.shape[1]))
+    if low_x >= high_x:
+        return np.empty(0, np.intp), np.empty(0, np.intp)
+
+    nonzero_y, nonzero_x = img[:, low_x:high_x].nonzero()
+    nonzero_x += low_x
+    in_band = np.abs(nonzero_x - fit_x[nonzero_y]) < margin
+    return nonzero_x[in_band], nonzero_y[in_band]
+
+
+#---LaneSmoother----
+
+
+class LaneSmoother(object):
+    # average the left and right fits of one stream over the last window frames,
+    # held in a fixed size ring buffer with a running sum so updates are O(1).
+    # with alpha set an exponential moving average is used instead, and with
+    # max_shift set a fit whose x position at y=0 or y=eval_y moves more than
+    # max_shift pixels from the current average is rejected as an outlier
+    def __init__(self, window=10, alpha=None, max_shift=None, eval_y=720):
+        self.window = window
+        self.alpha = alpha
+        self.max_shift = max_shift
+        self.eval_y = eval_y
+        self.rejected = 0
+        self._history = np.zeros((window, 2, 3))
+        self._sum = np.zeros((2, 3))
+        self._index = 0
+        self._count = 0
+        self._consecutive_rejects = 0
+        self._smoothed = None
+
+    def reset(self):
+        self._history[:] = 0
+        self._sum[:] = 0
+        self._index = 0
+        self._count = 0
+        self._consecutive_rejects = 0
+        self._smoothed = None
+
+    @property
+    def fits(self):
+        return self._smoothed
+
+    # convert the history to fits of an image resized by factor, so averaging
+    # can carry on when the resolution of the stream changes
+    def rescale(self, factor):
+        scale = geometry.rescale_fits(np.ones(3), factor)
+        self._history *= scale
+        self._sum *= scale
+        if self._smoothed is not None:
+            self._smoothed = self._smoothed*scale
+        self.eval_y *= factor
+        if self.max_shift is not None:
+            self.max_shift *= factor
+
+    def _is_outlier(self, fits):
+        rows = np.array([[0, 0, 1], [self.eval_y**2, self.eval_y, 1]], dtype=np.float64)
+        shift = np.abs((fits - self._smoothed) @ rows.T)
+        return np.max(shift) > self.max_shift
+
+    def update(self, left_fit, right_fit):
+        fits = np.array([left_fit, right_fit], dtype=np.float64)
+
+        # ignore sudden jumps, unless they persist for a whole window
+        if self.max_shift is not None and self._smoothed is not None and self._is_outlier(fits):
+            self.rejected += 1
+            self._consecutive_rejects += 1
+            if self._consecutive_rejects <= self.window:
+                return self._smoothed[0].copy(), self._smoothed[1].copy()
+            self.reset()
+        self._consecutive_rejects = 0
+
+        if self.alpha is not None:
+            if self._smoothed is None:
+                self._smoothed = fits
+            else:
+                self._smoothed = self.alpha*fits + (1 - self.alpha)*self._smoothed
+        else:
+            # replace the oldest entry and keep the running sum in step with it
+            if self._count == self.window:
+                self._sum -= self._history[self._index]
+            else:
+                self._count += 1
+            self._history[self._index] = fits
+            self._sum += fits
+            self._index = (self._index + 1) % self.window
+
+            # resum from the buffer once per lap so rounding errors can't build up
+            if self._index == 0:
+                self._sum = self._history[:self._count].sum(axis=0)
+            self._smoothed = self._sum/self._count
+
+        return self._smoothed[0].copy(), self._smoothed[1].copy()
+
+
+#---LaneDetection----
+
+
+class LaneDetection(object):
+    # result of detecting the lane lines in one warped binary frame. only the fits
+    # are computed up front, the evaluated lines and the debug image showing the
+    # search windows and lane pixels are built the first time they are asked for.
+    # lines holds the fits of every lane line that was found, left to right, with
+    # the ego lane's two at the indices in ego, and other_pixels the pixels of
+    # the lines of the neighbouring lanes
+    def __init__(self, img, left_pixels, right_pixels, left_fit, right_fit, windows=None, search="full", confidence=1.0,
+                 lines=None, ego=(0, 1), other_pixels=()):
+        self.img = img
+        self.left_pixels = left_pixels
+        self.right_pixels = right_pixels
+        self.lanes = (left_fit, right_fit)
+        self.lines = tuple(lines) if lines is not None else self.lanes
+        self.ego = ego
+        self.other_pixels = other_pixels
+        self.windows = windows
+        self.search = search
+        self.confidence = confidence
+        self._curves = None
+        self._debug_image = None
+
+    @property
+    def curves(self):
+        # use coefficients to generate x values for lines over every row
+        if self._curves is None:
+            left_fit_x, right_fit_x = geometry.evaluate_fits(self.lanes, self.img.shape[0])
+            self._curves = (left_fit_x, right_fit_x)
+        return self._curves
+
+    def debug_image(self):
+        if self._debug_image is not None:
+            return self._debug_image
+        output_windows = np.dstack((self.img, self.img, self.img))*255
+
+        # add boxes showing the sliding windows to the output image
+        if self.windows is not None:
+            windows, margin = self.windows
+            for window in windows:
+                window_low_y, window_high_y = window[:2]
+                for low_x in window[2:]:
+                    cv2.rectangle(output_windows, (int(low_x), int(window_low_y)), (int(low_x + 2*margin), int(window_high_y)), (100,255,255), 3)
+
+        # colour left and right lines for visualisation, and the lines of the
+        # neighbouring lanes in green
+        for pixels in self.other_pixels:
+            output_windows[pixels[1], pixels[0]] = [0, 255, 0]
+        output_windows[self.left_pixels[1], self.left_pixels[0]] = [255, 0, 100]
+        output_windows[self.right_pixels[1], self.right_pixels[0]] = [0, 100, 255]
+        self._debug_image = output_windows
+        return output_windows
+
+
+#---sliding_window()----
+
+
+def sliding_window(img, smoother=None, bases=None):
+    # full sliding window search of a single frame, averaged with smoother if given
+    left_pixels, right_pixels, windows = window_search(img, bases=bases)
 
     # find second order polynomial coefficients that fit the lines
-    left_fit = np.polyfit(left_y, left_x, 2)
-    right_fit = np.polyfit(right_y, right_x, 2)
-
-    # append coefficients to each list
-    left1.append(left_fit[0])
-    left2.append(left_fit[1])
-    left3.append(left_fit[2])
-    
-    right1.append(right_fit[0])
-    right2.append(right_fit[1])
-    right3.append(right_fit[2])
-    
-    # average out the left and right lane pixels
-    left_fit_[0] = np.mean(left1[-10:])
-    left_fit_[1] = np.mean(left2[-10:])
-    left_fit_[2] = np.mean(left3[-10:])
-    
-    right_fit_[0] = np.mean(right1[-10:])
-    right_fit_[1] = np.mean(right2[-10:])
-    right_fit_[2] = np.mean(right3[-10:])
-
-    # use coefficients to generate x and y values for lines
-    polyline = np.linspace(0, img.shape[0]-1, img.shape[0])
-    left_fit_x = left_fit_[0]*polyline**2 + left_fit_[1]*polyline + left_fit_[2]
-    right_fit_x = right_fit_[0]*polyline**2 + right_fit_[1]*polyline + right_fit_[2]
-
-    # colour left and right lines for visualisation
-    output_windows[nonzero_y[left_lane_indices], nonzero_x[left_lane_indices]] = [255, 0, 100]
-    output_windows[nonzero_y[right_lane_indices], nonzero_x[right_lane_indices]] = [0, 100, 255]
-
-    return output_windows, (left_fit_x, right_fit_x), (left_fit_, right_fit_)
+    left_fit = kernels.fit_quadratic(left_pixels[1], left_pixels[0])
+    right_fit = kernels.fit_quadratic(right_pixels[1], right_pixels[0])
+    if smoother is not None:
+        left_fit, right_fit = smoother.update(left_fit, right_fit)
+
+    detection = LaneDetection(img, left_pixels, right_pixels, left_fit, right_fit, windows)
+    return detection.debug_image(), detection.curves, detection.lanes
+
+
+#---LaneTracker----
+
+
+class LaneTracker(object):
+    # track the lane lines of one camera stream across frames. while the previous
+    # fit is trusted only a band of margin pixels around it is searched, and the
+    # full sliding window search, with windows window_margin pixels either side
+    # of their centre, is used to (re)acquire the lines. with adjacent
+    # the lines of the neighbouring lanes the full search finds are tracked as
+    # well, until they go out of sight. update returns a LaneDetection whose debug
+    # image is only drawn if it is asked for
+    def __init__(self, margin=100, min_pixels=200, min_lane_width=0.2, smoother=None, adjacent=True, window_margin=150):
+        self.smoother = smoother if smoother is not None else LaneSmoother()
+        self.margin = margin
+        self.window_margin = window_margin
+        self.min_pixels = min_pixels
+        self.min_lane_width = min_lane_width
+        self.adjacent = adjacent
+        self.scale = 1.0
+        self.left_fit = None
+        self.right_fit = None
+        self.neighbours = ([], [])
+        self.locked = False
+        self.confidence = 0.0
+
+        # counters describing how each frame was searched
+        self.frames = 0
+        self.targeted_searches = 0
+        self.full_searches = 0
+        self.fallbacks = 0
+
+    def reset(self):
+        self.left_fit = None
+        self.right_fit = None
+        self.neighbours = ([], [])
+        self.locked = False
+        self.confidence = 0.0
+        self.smoother.reset()
+
+    # carry on tracking in images resized to scale times the stream's resolution,
+    # converting the fits, smoother history and pixel margins to match
+    def set_scale(self, scale):
+        factor = scale/self.scale
+        self.scale = scale
+        if self.left_fit is not None:
+            self.left_fit = geometry.rescale_fits(self.left_fit, factor)
+            self.right_fit = geometry.rescale_fits(self.right_fit, factor)
+        self.neighbours = tuple([geometry.rescale_fits(fit, factor) for fit in side] for side in self.neighbours)
+        self.smoother.rescale(factor)
+        self.margin *= factor
+        self.window_margin *= factor
+        self.min_pixels *= factor*factor
+
+    def stats(self):
+        return {"frames": self.frames, "targeted_searches": self.targeted_searches,
+                "full_searches": self.full_searches, "fallbacks": self.fallbacks,
+                "locked": self.locked, "confidence": self.confidence,
+                "lines": 2 + len(self.neighbours[0]) + len(self.neighbours[1]),
+                "rejected_fits": self.smoother.rejected}
+
+    def _confidence(self, img, left_pixels, right_pixels, left_fit, right_fit):
+        # score a detection between 0 and 1 from the pixel support of the weaker
+        # line, dropping to 0 if the lines cross or sit implausibly close together
+        bottom = img.shape[0] - 1
+        width = np.polyval(right_fit, bottom) - np.polyval(left_fit, bottom)
+        if width < self.min_lane_width*img.shape[1]:
+            return 0.0
+        support = min(len(left_pixels[0]), len(right_pixels[0]))
+        return min(support/(2.0*self.min_pixels), 1.0)
+
+    # fit the lines of the neighbouring lanes with enough pixels, as (fit, pixels)
+    def _fit_lines(self, pixels):
+        return [(kernels.fit_quadratic(line[1], line[0]), line) for line in pixels if len(line[0]) >= self.min_pixels]
+
+    # bases and ego optionally give the starting columns for a full search and
+    # which two of them bound the ego lane, as found for a whole batch by
+    # batch_lane_bases
+    def update(self, img, bases=None, ego=None):
+        self.frames += 1
+
+        # search around the previous fit while locked on to the lane
+        if self.locked:
+            self.targeted_searches += 1
+            left_pixels = fit_search(img, self.left_fit, self.margin)
+            right_pixels = fit_search(img, self.right_fit, self.margin)
+            if len(left_pixels[0]) >= self.min_pixels and len(right_pixels[0]) >= self.min_pixels:
+                left_fit = kernels.fit_quadratic(left_pixels[1], left_pixels[0])
+                right_fit = kernels.fit_quadratic(right_pixels[1], right_pixels[0])
+                confidence = self._confidence(img, left_pixels, right_pixels, left_fit, right_fit)
+                if confidence > 0:
+                    neighbours = tuple(self._fit_lines([fit_search(img, fit, self.margin) for fit in side])
+                                       for side in self.neighbours)
+                    return self._accept(img, left_pixels, right_pixels, left_fit, right_fit, confidence, None, "targeted", neighbours)
+            self.fallbacks += 1
+
+        # otherwise fall back to the full sliding window search, of every line
+        # seeded from the column histogram or only the ego lane's two
+        self.full_searches += 1
+        if bases is None:
+            bases, ego = lane_bases(img)
+        elif ego is None:
+            ego = (0, 1)
+        if not self.adjacent:
+            bases, ego = np.asarray(bases)[list(ego)], (0, 1)
+        pixels, ego, windows = window_search_lines(img, margin=int(round(self.window_margin)), bases=bases, ego=ego)
+        left_pixels, right_pixels = pixels[ego[0]], pixels[ego[1]]
+        if len(left_pixels[0]) < 3 or len(right_pixels[0]) < 3:
+            if self.left_fit is None:
+                raise ValueError("no lane pixels found")
+            # keep the last fit but stop trusting it
+            self.locked = False
+            self.confidence = 0.0
+            self.neighbours = ([], [])
+            left_fit, right_fit = self.smoother.update(self.left_fit, self.right_fit)
+            return LaneDetection(img, left_pixels, right_pixels, left_fit, right_fit, windows, "lost", 0.0)
+
+        left_fit = kernels.fit_quadratic(left_pixels[1], left_pixels[0])
+        right_fit = kernels.fit_quadratic(right_pixels[1], right_pixels[0])
+        confidence = self._confidence(img, left_pixels, right_pixels, left_fit, right_fit)
+        neighbours = (self._fit_lines(pixels[:ego[0]]), self._fit_lines(pixels[ego[1] + 1:]))
+        return self._accept(img, left_pixels, right_pixels, left_fit, right_fit, confidence, windows, "full", neighbours)
+
+    def _accept(self, img, left_pixels, right_pixels, left_fit, right_fit, confidence, windows, search, neighbours=((), ())):
+        self.left_fit = left_fit
+        self.right_fit = right_fit
+        self.neighbours = tuple([fit for fit, _ in side] for side in neighbours)
+        self.confidence = confidence
+        self.locked = confidence >= 0.5
+        left_fit_, right_fit_ = self.smoother.update(left_fit, right_fit)
+
+        # only the ego lane is smoothed, the neighbouring lines are as found
+        lines = self.neighbours[0] + [left_fit_, right_fit_] + self.neighbours[1]
+        ego = (len(self.neighbours[0]), len(self.neighbours[0]) + 1)
+        other_pixels = [pixels for side in neighbours for _, pixels in side]
+        return LaneDetection(img, left_pixels, right_pixels, left_fit_, right_fit_, windows, search, confidence,
+                             lines, ego, other_pixels)
+
+
+#---track_scaled()----
+
+
+def track_scaled(tracker, img, height, width, scale=1.0):
+    # track the lanes in a processed frame of a height x width stream that was
+    # shrunk by scale, or with img None reuse the tracker's last smoothed fit.
+    # returns the LaneDetection (None when the fit was reused), the fits at the
+    # stream's resolution and the lane metrics, which are in metres either way
+    if img is None:
+        fits = tracker.smoother.fits
+        if fits is None:
+            raise ValueError("no lane fit to reuse")
+        fits = geometry.rescale_fits(fits, 1/tracker.scale)
+        return None, fits, geometry.lane_metrics(fits[0], fits[1], height, width)
+
+    if scale != tracker.scale:
+        tracker.set_scale(scale)
+    with profiler.span("sliding_window"):
+        detection = tracker.update(img)
+    with profiler.span("find_curve"):
+        metrics = find_curve(img, *detection.lanes)
+    fits = np.array(detection.lanes)
+    if img.shape[:2] != (height, width):
+        fits = geometry.rescale_fits(fits, width/img.shape[1], height/img.shape[0])
+    return detection, fits, metrics
+
+
+#---detect_batch()----
+
+
+def detect_batch(imgs, trackers=None):
+    # detect the lanes in an (N, H, W) stack of warped binary images, e.g. from
+    # process_image.process_batch. the lines of the whole stack are seeded from
+    # its column histograms in one go. trackers, if given, holds the LaneTracker of the stream
+    # each image came from, so every stream keeps its own state; otherwise each
+    # image is searched independently. returns the LaneDetection of each image
+    # (None where detection failed) and the batched lane metrics, which are NaN
+    # for failed images
+    height, width = imgs.shape[1:3]
+    bases = batch_lane_bases(imgs)
+    detections = []
+    fits = np.full((len(imgs), 2, 3), np.nan)
+    for i, img in enumerate(imgs):
+        try:
+            if trackers is not None:
+                detection = trackers[i].update(img, *bases[i])
+            else:
+                positions, ego = bases[i]
+                pixels, ego, windows = window_search_lines(img, bases=positions, ego=ego)
+                left_pixels, right_pixels = pixels[ego[0]], pixels[ego[1]]
+                left_fit = kernels.fit_quadratic(left_pixels[1], left_pixels[0])
+                right_fit = kernels.fit_quadratic(right_pixels[1], right_pixels[0])
+                detection = LaneDetection(img, left_pixels, right_pixels, left_fit, right_fit, windows)
+        except (ValueError, TypeError, np.linalg.LinAlgError):
+            detection = None
+        else:
+            fits[i] = detection.lanes
+        detections.append(detection)
+
+    with np.errstate(invalid="ignore"):
+        metrics = geometry.lane_metrics(fits[:, 0], fits[:, 1], height, width)
+    return detections, metrics
+
+
+#---as_coefficients()----
+
+
+def as_coefficients(fit, height):
+    # accept either polynomial coefficients or a line already evaluated over every
+    # row of the image, refitting the latter
+    fit = np.asarray(fit, dtype=np.float64)
+    if fit.shape[-1] != 3:
+        fit = kernels.fit_quadratic(geometry.y_grid(height), fit)
+    return fit
 
 
 #---find_curve()----
 
 
 def find_curve(img, left_fit, right_fit):
-    polyline = np.linspace(0, img.shape[0]-1, img.shape[0])
-    y_eval = np.max(polyline)
-
-    # calcualte meters per pixel
-    meters_pp_y = 25/720
-    meters_pp_x = 3/1280
-    
-    # calculate curve radius of the lane
-    new_left_fit = np.polyfit(polyline*meters_pp_y, left_fit*meters_pp_x, 2)
-    new_right_fit = np.polyfit(polyline*meters_pp_y, right_fit*meters_pp_x, 2)
-    left_curveradius = ((1 + (2*new_left_fit[0]*y_eval*meters_pp_y + new_left_fit[1])**2)**1.5) / np.absolute(2*new_left_fit[0])
-    right_curveradius = ((1 + (2*new_right_fit[0]*y_eval*meters_pp_y + new_right_fit[1])**2)**1.5) / np.absolute(2*new_right_fit[0])
-    
-    # calculate car position and distance from center of the lane
-    car_position = img.shape[1]/2
-    fit_left_to_img = new_left_fit[0]*img.shape[0]**2 + new_left_fit[1]*img.shape[0] + new_left_fit[2]
-    fit_right_to_img = new_right_fit[0]*img.shape[0]**2 + new_right_fit[1]*img.shape[0] + new_right_fit[2]
-    lane_center = (fit_left_to_img + fit_right_to_img)/2
-    lane_width = fit_left_to_img + fit_right_to_img
-    dist_from_center = (car_position - lane_center)*meters_pp_x / 10
-
-    return (left_curveradius, right_curveradius, dist_from_center, lane_width)
+    # curve radius of both lines, distance of the car from the center of the lane
+    # and the lane width, derived in closed form from the pixel space fits
+    height, width = img.shape[:2]
+    left_fit = as_coefficients(left_fit, height)
+    right_fit = as_coefficients(right_fit, height)
+    return geometry.lane_metrics(left_fit, right_fit, height, width)
 
 
 #---draw_lines()----
 
 
 def draw_lines(img, left, right, sensor_h, sensor_w):
-    polyline = np.linspace(0, img.shape[0]-1, img.shape[0])
+    # left and right are coefficients or lines evaluated over every row
+    polyline = geometry.y_grid(img.shape[0])
+    if np.size(left) == 3:
+        left = geometry.evaluate_fits(left, img.shape[0])
+    if np.size(right) == 3:
+        right = geometry.evaluate_fits(right, img.shape[0])
     bin_img = np.zeros_like(img)
 
     # calculate points of a polygon to fill based of result of lane detection
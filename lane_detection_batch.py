@@ -0,0 +1,147 @@
+import argparse
+import csv
+import json
+import time
+from multiprocessing import Pool
+
+import process_image as process
+import lane_detection as lane
+import lane_kernels as kernels
+from instrumentation import profiler
+from frame_source import frame_reader
+
+RESULT_FIELDS = ["frame", "left_a", "left_b", "left_c", "right_a", "right_b", "right_c",
+                 "left_curvature", "right_curvature", "dist_from_center", "lane_width",
+                 "search", "time_ms", "error"]
+
+
+#---iter_frames()----
+
+
+def iter_frames(source, raw_size=None):
+    # (index, frame) pairs from any source frame_source.frame_reader reads, the
+    # same reader main.py's --source uses
+    return frame_reader(source, raw_size)()
+
+
+#---detect_frame()----
+
+
+def detect_frame(frame, tracker=None, process_mode="full"):
+    # run the lane detection stages on one frame and return a result row. without
+    # a tracker every frame is searched from scratch so frames are independent
+    index, img = frame
+    height, width = img.shape[:2]
+    row = dict.fromkeys(RESULT_FIELDS, "")
+    row["frame"] = index
+    start = time.perf_counter()
+    try:
+        img_ = process.process_image(img, height, width, process_mode)
+        with profiler.span("sliding_window"):
+            if tracker is not None:
+                detection = tracker.update(img_)
+                fits, search = detection.lanes, detection.search
+            else:
+                # only the fits are wanted, so skip the debug image sliding_window draws
+                left_pixels, right_pixels, _ = lane.window_search(img_)
+                fits = (kernels.fit_quadratic(left_pixels[1], left_pixels[0]),
+                        kernels.fit_quadratic(right_pixels[1], right_pixels[0]))
+                search = "full"
+        with profiler.span("find_curve"):
+            curve_radius = lane.find_curve(img_, fits[0], fits[1])
+    except Exception as error:
+        row["error"] = str(error)
+    else:
+        row.update(zip(["left_a", "left_b", "left_c"], map(float, fits[0])))
+        row.update(zip(["right_a", "right_b", "right_c"], map(float, fits[1])))
+        row["left_curvature"], row["right_curvature"] = float(curve_radius[0]), float(curve_radius[1])
+        row["dist_from_center"], row["lane_width"] = float(curve_radius[2]), float(curve_radius[3])
+        row["search"] = search
+    row["time_ms"] = (time.perf_counter() - start)*1000
+    return row
+
+
+def _detect_stateless(args):
+    frame, process_mode = args
+    return detect_frame(frame, None, process_mode)
+
+
+#---run_batch()----
+
+
+def run_batch(frames, tracking=False, processes=1, process_mode="full"):
+    # yield result rows in frame order. tracking mode keeps a LaneTracker across
+    # frames and so runs in this process, stateless mode can use a process pool
+    if tracking:
+        tracker = lane.LaneTracker()
+        for frame in frames:
+            yield detect_frame(frame, tracker, process_mode)
+    elif processes > 1:
+        with Pool(processes) as pool:
+            for row in pool.imap(_detect_stateless, ((frame, process_mode) for frame in frames), chunksize=4):
+                yield row
+    else:
+        for frame in frames:
+            yield detect_frame(frame, None, process_mode)
+
+
+#---write_results()----
+
+
+def write_results(rows, path):
+    # write rows to csv, or to json if the path ends in .json, as they arrive
+    if path.lower().endswith(".json"):
+        rows = list(rows)
+        with open(path, "w") as f:
+            json.dump(rows, f, indent=1)
+        return len(rows)
+
+    count = 0
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    return count
+
+
+#---parse_size()----
+
+
+def parse_size(text):
+    width, height = text.lower().split("x")
+    return int(width), int(height)
+
+
+#---main()----
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run lane detection over recorded frames without CARLA")
+    parser.add_argument("source", help="image directory, video file, .npy frame stack, .ldwrec recording or raw bgra dump")
+    parser.add_argument("-o", "--output", default="lane_results.csv", help="csv or .json file to write per-frame results to")
+    parser.add_argument("--tracking", action="store_true", help="track lanes across frames instead of detecting each frame independently")
+    parser.add_argument("-j", "--processes", type=int, default=1, help="worker processes for stateless mode")
+    parser.add_argument("--process-mode", default="full", choices=["full", "roi", "warp_first"],
+                        help="roi is faster than full with nearly the same result, warp_first fastest but loses the far dashes")
+    parser.add_argument("--raw-size", type=parse_size, help="WIDTHxHEIGHT of frames in a raw dump")
+    parser.add_argument("--profile-report", metavar="PATH", help="write per stage timings of this process to a json or csv file")
+    args = parser.parse_args(argv)
+    profiler.enabled = args.profile_report is not None
+
+    start = time.perf_counter()
+    frames = iter_frames(args.source, args.raw_size)
+    rows = run_batch(frames, args.tracking, args.processes, args.process_mode)
+    count = write_results(rows, args.output)
+    elapsed = time.perf_counter() - start
+
+    fps = count/elapsed if elapsed > 0 else 0.0
+    print("processed %d frames in %.2f s (%.1f FPS) with %s kernels, results written to %s" % (count, elapsed, fps, kernels.BACKEND, args.output))
+    if args.profile_report:
+        profiler.set_counter("lane kernels", kernels.BACKEND)
+        profiler.dump(args.profile_report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+from functools import lru_cache
+
+import numpy as np
+
+
+# metres of road covered by the full height and width of the bird's-eye image,
+# i.e. 25/720 m per pixel vertically and 3/1280 m per pixel across at 1280x720
+WARPED_LENGTH_M = 25.0
+WARPED_WIDTH_M = 3.0
+
+
+#---y_grid()----
+
+
+@lru_cache(maxsize=16)
+def y_grid(height):
+    # the rows 0..height-1 that fits are evaluated over, shared between callers
+    grid = np.linspace(0, height-1, height)
+    grid.setflags(write=False)
+    return grid
+
+
+def metres_per_pixel(height, width):
+    return WARPED_LENGTH_M/height, WARPED_WIDTH_M/width
+
+
+#---evaluate_fits()----
+
+
+def evaluate_fits(fits, height):
+    # evaluate x = a*y**2 + b*y + c over every row for one (3,) fit or a batch of
+    # (..., 3) fits at once, giving (height,) or (..., height) x positions
+    fits = np.asarray(fits, dtype=np.float64)
+    polyline = y_grid(height)
+    return (fits[..., 0, None]*polyline + fits[..., 1, None])*polyline + fits[..., 2, None]
+
+
+#---metric_coefficients()----
+
+
+def metric_coefficients(fits, height, width):
+    # rescale pixel space coefficients to metres in closed form: with x_m = mx*x
+    # and y_m = my*y, x_m = (mx/my**2)*a*y_m**2 + (mx/my)*b*y_m + mx*c
+    meters_pp_y, meters_pp_x = metres_per_pixel(height, width)
+    scale = np.array([meters_pp_x/meters_pp_y**2, meters_pp_x/meters_pp_y, meters_pp_x])
+    return np.asarray(fits, dtype=np.float64)*scale
+
+
+#---rescale_fits()----
+
+
+def rescale_fits(fits, x_factor, y_factor=None):
+    # convert fits to an image resized by x_factor across and y_factor down: with
+    # x' = fx*x and y' = fy*y, x' = (fx/fy**2)*a*y'**2 + (fx/fy)*b*y' + fx*c
+    y_factor = x_factor if y_factor is None else y_factor
+    scale = np.array([x_factor/y_factor**2, x_factor/y_factor, x_factor])
+    return np.asarray(fits, dtype=np.float64)*scale
+
+
+#---lane_metrics()----
+
+
+def lane_metrics(left_fits, right_fits, height, width):
+    # curve radius of each line and the vehicle's distance from the lane centre and
+    # lane width in metres, all measured at the bottom of the image nearest the
+    # car. works on single (3,) fits or on (N, 3) batches of frames or streams
+    meters_pp_y, meters_pp_x = metres_per_pixel(height, width)
+    left_fits = np.asarray(left_fits, dtype=np.float64)
+    right_fits = np.asarray(right_fits, dtype=np.float64)
+    y_eval = height - 1
+
+    radii = []
+    for fits in (left_fits, right_fits):
+        metric = metric_coefficients(fits, height, width)
+        slope = 2*metric[..., 0]*y_eval*meters_pp_y + metric[..., 1]
+        with np.errstate(divide="ignore"):
+            radii.append((1 + slope**2)**1.5/np.absolute(2*metric[..., 0]))
+
+    # calculate car position and distance from center of the lane
+    left_x = (left_fits[..., 0]*y_eval + left_fits[..., 1])*y_eval + left_fits[..., 2]
+    right_x = (right_fits[..., 0]*y_eval + right_fits[..., 1])*y_eval + right_fits[..., 2]
+    lane_center = (left_x + right_x)/2
+    dist_from_center = (width/2 - lane_center)*meters_pp_x
+    lane_width = (right_x - left_x)*meters_pp_x
+    return radii[0], radii[1], dist_from_center, lane_width
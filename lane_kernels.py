@@ -0,0 +1,181 @@
+import numpy as np
+
+# the window scan and the quadratic fits run as compiled loops when numba is
+# installed, otherwise as the numpy code below. use_backend() switches between
+# them, e.g. to compare the two
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+#---_window_scan_numpy()----
+
+
+def _window_scan_numpy(nonzero_x, band_starts, bases, margin, minpix):
+    # follow each line up the row bands from its base column, recentring the
+    # window on the mean column of the pixels it caught. band_starts holds the
+    # index into the row sorted nonzero pixels where each band begins, from the
+    # bottom of the image. returns the window centres, one row per band, and the
+    # caught pixel indices of every line as one array split at offsets
+    num_windows = len(band_starts) - 1
+    current = [int(base) for base in bases]
+    centres = np.empty((num_windows, len(current)), np.int64)
+    lane_indices = [[] for _ in current]
+    for window in range(num_windows):
+        centres[window] = current
+        band_start = band_starts[window+1]
+        band_x = nonzero_x[band_start:band_starts[window]]
+        for line, x in enumerate(current):
+            indices = ((band_x >= x - margin) & (band_x < x + margin)).nonzero()[0] + band_start
+            lane_indices[line].append(indices)
+            if len(indices) > minpix:
+                current[line] = int(np.mean(nonzero_x[indices]))
+
+    lane_indices = [np.concatenate(indices) for indices in lane_indices]
+    offsets = np.cumsum([0] + [len(indices) for indices in lane_indices])
+    indices = np.concatenate(lane_indices) if lane_indices else np.empty(0, np.intp)
+    return centres, indices, offsets
+
+
+#---_quadratic_sums_numpy()----
+
+
+def _quadratic_sums_numpy(x, y, w, centre, scale):
+    # the sums of the normal equations of a quadratic in t = (x - centre)/scale,
+    # weighted by w squared as np.polyfit weights residuals
+    t = (np.asarray(x, np.float64) - centre)/scale
+    y = np.asarray(y, np.float64)
+    t2 = t*t
+    if w is None:
+        return (float(len(t)), t.sum(), t2.sum(), t2 @ t, t2 @ t2, y.sum(), y @ t, y @ t2)
+    w2 = np.asarray(w, np.float64)**2
+    wt = w2*t
+    wt2 = w2*t2
+    return (w2.sum(), wt.sum(), wt2.sum(), wt2 @ t, wt2 @ t2, w2 @ y, wt @ y, wt2 @ y)
+
+
+if numba is not None:
+
+    #---_window_scan_numba()----
+
+
+    @numba.njit(cache=True, nogil=True)
+    def _window_scan_numba(nonzero_x, band_starts, bases, margin, minpix):
+        # the same scan as _window_scan_numpy. each line only depends on its own
+        # windows, so lines are followed one after the other: a first pass finds
+        # the window centres and how many pixels each line catches, a second
+        # collects their indices in the same order the numpy scan does
+        num_windows = len(band_starts) - 1
+        lines = len(bases)
+        centres = np.empty((num_windows, lines), np.int64)
+        counts = np.zeros(lines, np.int64)
+        for line in range(lines):
+            current = np.int64(bases[line])
+            for window in range(num_windows):
+                centres[window, line] = current
+                total = 0
+                count = 0
+                for i in range(band_starts[window+1], band_starts[window]):
+                    x = nonzero_x[i]
+                    if x >= current - margin and x < current + margin:
+                        total += x
+                        count += 1
+                counts[line] += count
+                if count > minpix:
+                    current = np.int64(total/count)
+
+        offsets = np.zeros(lines + 1, np.int64)
+        for line in range(lines):
+            offsets[line+1] = offsets[line] + counts[line]
+        indices = np.empty(offsets[lines], np.int64)
+        for line in range(lines):
+            k = offsets[line]
+            for window in range(num_windows):
+                current = centres[window, line]
+                for i in range(band_starts[window+1], band_starts[window]):
+                    x = nonzero_x[i]
+                    if x >= current - margin and x < current + margin:
+                        indices[k] = i
+                        k += 1
+        return centres, indices, offsets
+
+
+    #---_quadratic_sums_numba()----
+
+
+    @numba.njit(cache=True, nogil=True)
+    def _quadratic_sums_numba(x, y, w, centre, scale):
+        # the sums of _quadratic_sums_numpy in a single pass, w may be empty for
+        # an unweighted fit
+        s0 = s1 = s2 = s3 = s4 = r0 = r1 = r2 = 0.0
+        weighted = len(w) > 0
+        for i in range(len(x)):
+            t = (x[i] - centre)/scale
+            t2 = t*t
+            w2 = w[i]*w[i] if weighted else 1.0
+            s0 += w2
+            s1 += w2*t
+            s2 += w2*t2
+            s3 += w2*t2*t
+            s4 += w2*t2*t2
+            r0 += w2*y[i]
+            r1 += w2*t*y[i]
+            r2 += w2*t2*y[i]
+        return s0, s1, s2, s3, s4, r0, r1, r2
+
+
+BACKENDS = ("numba", "numpy") if numba is not None else ("numpy",)
+BACKEND = BACKENDS[0]
+
+
+#---use_backend()----
+
+
+def use_backend(backend):
+    # pick "numba" or "numpy" for the window scan and fits, numba only if installed
+    global BACKEND
+    if backend not in BACKENDS:
+        raise ValueError("lane kernel backend %s is not available, choose from %s" % (backend, ", ".join(BACKENDS)))
+    BACKEND = backend
+
+
+#---window_scan()----
+
+
+def window_scan(nonzero_x, band_starts, bases, margin, minpix):
+    if BACKEND == "numba":
+        return _window_scan_numba(np.ascontiguousarray(nonzero_x, np.int64), np.ascontiguousarray(band_starts, np.int64),
+                                  np.asarray(bases, np.int64), int(margin), int(minpix))
+    return _window_scan_numpy(nonzero_x, band_starts, bases, margin, minpix)
+
+
+#---fit_quadratic()----
+
+
+def fit_quadratic(x, y, w=None):
+    # np.polyfit(x, y, 2, w=w) from the 3x3 normal equations in closed form, with
+    # x centred and scaled to [-1, 1] so the sums stay well conditioned. inputs
+    # np.polyfit would reject or that leave the equations (nearly) singular, such
+    # as pixels from fewer than three rows, are handed to np.polyfit, so errors
+    # and degenerate fits come out as they always have
+    if len(x) < 3:
+        return np.polyfit(x, y, 2, w=w)
+    low, high = float(np.min(x)), float(np.max(x))
+    centre = (low + high)/2
+    scale = max((high - low)/2, 1.0)
+    if BACKEND == "numba":
+        weights = np.empty(0) if w is None else np.ascontiguousarray(w, np.float64)
+        sums = _quadratic_sums_numba(np.ascontiguousarray(x, np.float64), np.ascontiguousarray(y, np.float64),
+                                     weights, centre, scale)
+    else:
+        sums = _quadratic_sums_numpy(x, y, w, centre, scale)
+    s0, s1, s2, s3, s4, r0, r1, r2 = sums
+    normal = np.array([[s4, s3, s2], [s3, s2, s1], [s2, s1, s0]])
+    if not abs(np.linalg.det(normal)) > 1e-9*s0**3:
+        return np.polyfit(x, y, 2, w=w)
+    a, b, c = np.linalg.solve(normal, np.array([r2, r1, r0]))
+
+    # back from t = (x - centre)/scale to x
+    a, b = a/scale**2, b/scale
+    return np.array([a, b - 2*a*centre, a*centre**2 - b*centre + c])
@@ -1,10 +1,38 @@
-import carla
+import argparse
+import os
 import pygame
 import random
+import time
 import cv2
 import numpy as np
 import process_image as process
 import lane_detection as lane
+import lane_kernels as kernels
+from frame_pipeline import FramePipeline
+from frame_ingest import BufferPool, bgra_to_rgb, ingest_frame
+from frame_recorder import FrameRecorder
+from frame_source import CarlaSensorSource, open_source
+from departure_warning import DeparturePredictor
+from frame_scheduler import FrameScheduler
+from process_detection import ProcessDetector
+from renderer import Renderer, WarningOverlay
+from instrumentation import profiler
+
+# the simulator api is only needed to run the loop, so the processing stages
+# can still be imported without it. use_backend() swaps in another module with
+# the same api, such as fake_carla
+try:
+    import carla
+except ImportError:
+    carla = None
+
+
+#---use_backend()----
+
+
+def use_backend(backend):
+    global carla
+    carla = backend
 
 
 #---init_world()----
@@ -12,6 +40,8 @@ import lane_detection as lane
 
 def init_world():
     # connect to carla server and select world
+    if carla is None:
+        raise ImportError("the carla package is not installed, see use_backend()")
     client = carla.Client("localhost", 2000)
     client.set_timeout(30.0)
     world = client.load_world("Town05")
@@ -28,7 +58,7 @@ def init_world():
 #---init_vehicle()----
 
 
-def init_vehicle(world):
+def init_vehicle(world, transform=None):
 # select Tesla model 3 for use in the sim world
     blueprint_library = world.get_blueprint_library()
     bp = blueprint_library.filter("model3")[0]
@@ -38,9 +68,10 @@ def init_vehicle(world):
         colour = random.choice(bp.get_attribute("colour").recommended_values)
         bp.set_attribute("colour", colour)
 
-    # select random spawn point and store it
-    spawn_points = world.get_map().get_spawn_points()
-    transform = random.choice(spawn_points)
+    # select random spawn point and store it, unless one was given
+    if transform is None:
+        spawn_points = world.get_map().get_spawn_points()
+        transform = random.choice(spawn_points)
 
     # spawn vehicle in the world and notify user it's created
     vehicle = world.spawn_actor(bp, transform)
@@ -52,19 +83,22 @@ def init_vehicle(world):
 #---init_vehicle_sensors()----
 
 
-def init_vehicle_sensors(world, vehicle, blueprint_library):
-    # create a new RGB camera positioned behind the vehicle for user control
-    sensor_bp = blueprint_library.find('sensor.camera.rgb')
-    sensor_bp.set_attribute("image_size_x", "1280")
-    sensor_bp.set_attribute("image_size_y", "720")
-    sensor_transform = carla.Transform(carla.Location(x=-5, z=3), carla.Rotation(pitch=-20))
-    sensor = world.spawn_actor(sensor_bp, sensor_transform, attach_to=vehicle)
-    print("created %s" % sensor.type_id)
+def init_vehicle_sensors(world, vehicle, blueprint_library, sensor_image_w=1280, sensor_image_h=720, control_camera=True):
+    # create a new RGB camera positioned behind the vehicle for user control,
+    # vehicles nobody drives can go without it
+    sensor = None
+    if control_camera:
+        sensor_bp = blueprint_library.find('sensor.camera.rgb')
+        sensor_bp.set_attribute("image_size_x", str(sensor_image_w))
+        sensor_bp.set_attribute("image_size_y", str(sensor_image_h))
+        sensor_transform = carla.Transform(carla.Location(x=-5, z=3), carla.Rotation(pitch=-20))
+        sensor = world.spawn_actor(sensor_bp, sensor_transform, attach_to=vehicle)
+        print("created %s" % sensor.type_id)
 
     # create a new RGB camera positioned at the front of the vehicle for lane detection
     lane_bp = blueprint_library.find('sensor.camera.rgb')
-    lane_bp.set_attribute("image_size_x", "1280")
-    lane_bp.set_attribute("image_size_y", "720")
+    lane_bp.set_attribute("image_size_x", str(sensor_image_w))
+    lane_bp.set_attribute("image_size_y", str(sensor_image_h))
     lane_bp.set_attribute("fov", "100")
     lane_sensor_transform = carla.Transform(carla.Location(x=1.5, z=1.5), carla.Rotation(pitch=-10))
     lane_sensor = world.spawn_actor(lane_bp, lane_sensor_transform, attach_to=vehicle)
@@ -78,16 +112,6 @@ def init_vehicle_sensors(world, vehicle, blueprint_library):
     return sensor, lane_sensor, lane_invasion_sensor
 
 
-#---RenderObject----
-
-
-class RenderObject(object):
-    # initialise and render object to pass to the PyGame surface
-    def __init__(self, width, height):
-        init_image = np.random.randint(0, 255, (height, width, 3), dtype="uint8")
-        self.surface = pygame.surfarray.make_surface(init_image.swapaxes(0, 1))
-
-
 #---get_text_dimensions()----
 
 
@@ -101,71 +125,224 @@ def get_text_dimensions(img, text, font):
 #---vehicle_control_callback()----
 
 
-def vehicle_control_callback(data, obj):
-    # reshape raw rgb sensor data
-    # display rgb data to the window
-    img = np.reshape(np.copy(data.raw_data), (data.height, data.width, 4))
-    img = img[:,:,:3]
-    img = img[:, :, ::-1]
-    obj.surface = pygame.surfarray.make_surface(img.swapaxes(0,1))
+def vehicle_control_callback(data, pipeline, pool):
+    # copy the raw sensor data into a pooled buffer and queue it, nothing else
+    # happens on the sensor thread
+    profiler.frame_received("control", data.frame)
+    pipeline.submit((data.frame, ingest_frame(data, pool)))
 
 
-#---lane_detection_callback()----
+#---vehicle_control_stage()----
+
+
+def vehicle_control_stage(frame):
+    # nothing to do before display, the bgra frame is converted straight into its pane
+    return frame
 
 
-def lane_detection_callback(data, lane_obj, perspective_obj, sliding_obj, veh, sensor_image_w, sensor_image_h):
-    # reshape raw rgb sensor data
-    # call process_image to warp the image and display it to window
-    img = np.reshape(np.copy(data.raw_data), (data.height, data.width, 4))
-    img_ = process.process_image(img, sensor_image_h, sensor_image_w)
-    perspective_obj.surface = pygame.surfarray.make_surface(img_.swapaxes(0,1))
-    img = img[:,:,:3]
-    img = img[:, :, ::-1]
+#---control_display_stage()----
 
-    # perform lane detection and display results to the window
-    output_windows, curves, lanes = lane.sliding_window(img_)
-    sliding_obj.surface = pygame.surfarray.make_surface(output_windows.swapaxes(0,1)) 
-    curve_radius = lane.find_curve(img_, curves[0], curves[1])
-    lanes = lane.draw_lines(img, curves[0], curves[1], sensor_image_h, sensor_image_w)
+
+def control_display_stage(frame, pane, pool):
+    # write the frame into its pane's back buffer and recycle it
+    frame_id, img = frame
+    pane.update(img)
+    pool.release(img)
+    return frame_id
+
+
+#---lane_detection_callback()----
+
+
+def lane_detection_callback(data, pipeline, pool, sensor_image_w, sensor_image_h, scheduler=None):
+    # copy the raw sensor data into a pooled buffer and queue it for lane
+    # detection, nothing else happens on the sensor thread. a scheduler picks
+    # the scale the frame is detected at, or None to skip detecting it
+    profiler.frame_received("lane", data.frame)
+    scale = scheduler.next_frame() if scheduler is not None else 1.0
+    pipeline.submit((data.frame, ingest_frame(data, pool), sensor_image_w, sensor_image_h, scale))
+
+
+#---lane_processing_stage()----
+
+
+def lane_processing_stage(frame):
+    # threshold and warp the image, this holds no state so it can run on any worker.
+    # frames with a scale below 1 are shrunk first, and with no scale they are
+    # passed through untouched so the last fit can be reused for them
+    frame_id, img, sensor_image_w, sensor_image_h, scale = frame
+    if scale is None:
+        return frame_id, img, None, None, 0.0
+    start = time.perf_counter()
+    img_ = process.process_scaled(img, sensor_image_h, sensor_image_w, scale)
+    return frame_id, img, img_, scale, (time.perf_counter() - start)*1000
+
+
+#---lane_tracking_stage()----
+
+
+def lane_tracking_stage(result, tracker, veh, sensor_image_w, sensor_image_h, debug_every=1, pool=None, predictor=None, on_departure=None, scheduler=None):
+    # runs on processed frames strictly in order as the lane tracker and the
+    # departure predictor are stateful
+    frame_id, raw, img_, scale, process_ms = result
+    start = time.perf_counter()
+
+    # only keep the warped and sliding window images for display every
+    # debug_every frames, or never if debug_every is 0
+    show_debug = img_ is not None and debug_every > 0 and frame_id % debug_every == 0
+
+    # perform lane detection in the resolution of the processed frame, or carry
+    # the last fit over if detection was skipped for this frame
+    try:
+        detection, fits, curve_radius = lane.track_scaled(tracker, img_, sensor_image_h, sensor_image_w, scale)
+        if detection is not None and scheduler is not None:
+            scheduler.record(process_ms + (time.perf_counter() - start)*1000, scale)
+    except Exception:
+        # the frame never reaches lane_overlay_stage, which releases it otherwise
+        if pool is not None:
+            pool.release(raw)
+        raise
+
+    lanes = lane_overlay_stage(frame_id, raw, fits, curve_radius, veh, sensor_image_w, sensor_image_h, pool,
+                               predictor if detection is not None else None, on_departure)
+
+    if show_debug:
+        with profiler.span("debug_image"):
+            windows = detection.debug_image()
+            if img_.shape[:2] != (sensor_image_h, sensor_image_w):
+                img_ = cv2.resize(img_, (sensor_image_w, sensor_image_h), interpolation=cv2.INTER_NEAREST)
+                windows = cv2.resize(windows, (sensor_image_w, sensor_image_h), interpolation=cv2.INTER_NEAREST)
+        return frame_id, lanes, img_, windows
+    return frame_id, lanes, None, None
+
+
+#---lane_result_stage()----
+
+
+def lane_result_stage(result, veh, sensor_image_w, sensor_image_h, predictor=None, on_departure=None, scheduler=None):
+    # lane detection ran in a worker process and only the fits and metrics came
+    # back, finish the frame the same way lane_tracking_stage does. the frame's
+    # shared memory slot is released by the detector once this returns
+    stream, frame_id, raw, scale, fits, curve_radius, search, detection_ms, error = result
+    if error is not None:
+        raise ValueError(error)
+    detected = search != "skipped"
+    if detected and profiler.enabled:
+        profiler.record("detection_process", detection_ms)
+    if detected and scheduler is not None:
+        scheduler.record(detection_ms, scale)
+    lanes = lane_overlay_stage(frame_id, raw, fits, curve_radius, veh, sensor_image_w, sensor_image_h, None,
+                               predictor if detected else None, on_departure)
+    return frame_id, lanes, None, None
+
+
+#---lane_overlay_stage()----
+
+
+def lane_overlay_stage(frame_id, raw, fits, curve_radius, veh, sensor_image_w, sensor_image_h, pool=None, predictor=None, on_departure=None):
+    # draw the detected lane and the vehicle information over the camera frame.
+    # the raw frame goes back to pool once the overlay is drawn, or if anything
+    # up to then fails
+    try:
+        img = bgra_to_rgb(raw)
+        speed = veh.get_velocity().length()
+
+        # warn ahead of the lane invasion sensor when a line is about to be crossed
+        prediction = None
+        if predictor is not None:
+            with profiler.span("departure_predictor"):
+                prediction = predictor.update(frame_id, curve_radius, fits, speed)
+            if prediction.warn and on_departure is not None:
+                on_departure(prediction)
+
+        with profiler.span("draw_lines"):
+            lanes = lane.draw_lines(img, fits[0], fits[1], sensor_image_h, sensor_image_w)
+    finally:
+        if pool is not None:
+            pool.release(raw)
 
     # add vehicle information to the lane display
-    font = cv2.FONT_HERSHEY_DUPLEX
-    font_colour = (0, 0, 0)
-    font_size = 0.5
-    avg_lane_curve = np.mean([curve_radius[0], curve_radius[1]])
+    with profiler.span("text_overlay"):
+        font = cv2.FONT_HERSHEY_DUPLEX
+        font_colour = (0, 0, 0)
+        font_size = 0.5
+        avg_lane_curve = np.mean([curve_radius[0], curve_radius[1]])
+
+        veh_offset_text = "Dist. from center: {:.4f} m".format(curve_radius[2])
+        veh_offset_x = get_text_dimensions(lanes, veh_offset_text, font)
+
+        lane_curve_text = "Lane curvature: {:.0f} m".format(avg_lane_curve)
+        lane_curve_x = get_text_dimensions(lanes, lane_curve_text, font)
+
+        vehicle_speed_text = "Vehicle speed: {:.1f}".format(speed*2.237) + " mph"
+        vehicle_speed_x = get_text_dimensions(lanes, vehicle_speed_text, font)
+
+        cv2.putText(lanes, veh_offset_text, (int(veh_offset_x), 710), font, font_size, font_colour, 1)
+        cv2.putText(lanes, lane_curve_text, (int(lane_curve_x), 690), font, font_size, font_colour, 1)
+        cv2.putText(lanes, vehicle_speed_text, (int(vehicle_speed_x), 670), font, font_size, font_colour, 1)
+
+        if prediction is not None and prediction.time_to_crossing < 10:
+            crossing_text = "Line crossing in {:.1f} s ({})".format(prediction.time_to_crossing, prediction.side_name)
+            crossing_x = get_text_dimensions(lanes, crossing_text, font)
+            cv2.putText(lanes, crossing_text, (int(crossing_x), 650), font, font_size, font_colour, 1)
+    return lanes
+
 
-    veh_offset_text = "Dist. from center: {:.4f} m".format(curve_radius[2])
-    veh_offset_x = get_text_dimensions(lanes, veh_offset_text, font)
+#---lane_display_stage()----
 
-    lane_curve_text = "Lane curvature: {:.0f} m".format(avg_lane_curve)
-    lane_curve_x = get_text_dimensions(lanes, lane_curve_text, font)
 
-    vehicle_speed_text = "Vehicle speed: {:.1f}".format(veh.get_velocity().length()*2.237) + " mph"
-    vehicle_speed_x = get_text_dimensions(lanes, vehicle_speed_text, font)
+def lane_display_stage(result, lane_pane, perspective_pane, sliding_pane):
+    # write the lane overlay, and the debug views when there are any, into their panes
+    frame_id, lanes, warped, windows = result
+    lane_pane.update(lanes)
+    if warped is not None:
+        perspective_pane.update(warped, scale=255)
+        sliding_pane.update(windows)
+    return frame_id
 
-    cv2.putText(lanes, veh_offset_text, (int(veh_offset_x), 710), font, font_size, font_colour, 1)
-    cv2.putText(lanes, lane_curve_text, (int(lane_curve_x), 690), font, font_size, font_colour, 1)
-    cv2.putText(lanes, vehicle_speed_text, (int(vehicle_speed_x), 670), font, font_size, font_colour, 1)
-    lane_obj.surface = pygame.surfarray.make_surface(lanes.swapaxes(0,1))
+
+#---record_frame_callback()----
+
+
+def record_frame_callback(data, recorder, veh, control_obj):
+    # store the raw lane camera frame with the vehicle state so the drive can be replayed
+    recorder.write(data.raw_data, data.frame, data.timestamp, veh.get_velocity().length(), control_obj._blinker_active)
 
 
 #---lane_departure_callback()----
 
 
-def lane_departure_callback(event, invasion_obj, control_obj):
+def lane_departure_callback(event, invasion_obj, control_obj, recorder=None):
     # create list containing the lane type involved in collision
     lane_types = set(x.type for x in event.crossed_lane_markings)
     lane_text = ['%r' % str(x).split()[-1] for x in lane_types]
     print(f"Collision at: {lane_text[0]}")
+    if recorder is not None:
+        recorder.add_event(event.frame, event.timestamp, lane_text)
+    show_departure_warning(invasion_obj, control_obj)
+
+
+#---predicted_departure_callback()----
+
 
+def predicted_departure_callback(prediction, invasion_obj, control_obj):
+    # the departure predictor expects a line to be crossed soon, warn now
+    print("Line crossing predicted in {:.2f} s on the {}".format(prediction.time_to_crossing, prediction.side_name))
+    show_departure_warning(invasion_obj, control_obj)
+
+
+#---show_departure_warning()----
+
+
+def show_departure_warning(invasion_obj, control_obj):
     #initialise warning sound
     warning_sound = pygame.mixer.Sound("car-beeping-2.wav")
 
-    # if the blinkers are off then display the warning and play the warning sound
+    # if the blinkers are off then display the warning and play the warning sound.
+    # this runs on sensor and worker threads, so the overlay is only flagged here
+    # and drawn by the game loop
     if control_obj._blinker_active == False:
-        image = pygame.image.load("warning_icon.png")
-        invasion_obj.set_alpha(255)
-        invasion_obj.blit(image, (10,10))
+        invasion_obj.show()
         pygame.mixer.Sound.play(warning_sound)
         
 
@@ -277,57 +454,132 @@ class ControlObject(object):
         self._vehicle.apply_control(self._control)
 
 
+#---draw_profiler_hud()----
+
+
+def draw_profiler_hud(display, font):
+    # draw the profiler's stage timings over a dark box in the top right corner
+    lines = profiler.hud_lines()
+    line_height = font.get_linesize()
+    width = max(font.size(line)[0] for line in lines) + 10
+    box = pygame.Surface((width, line_height*len(lines) + 10))
+    box.set_alpha(180)
+    box.fill((0, 0, 0))
+    x = display.get_width() - width
+    display.blit(box, (x, 0))
+    for i, line in enumerate(lines):
+        display.blit(font.render(line, True, (255, 255, 255)), (x + 5, 5 + i*line_height))
+
+
 #---game_loop()----
 
 
-def game_loop(world, veh, sensor, lane_sensor, lane_invasion_sensor, sensor_image_w, sensor_image_h):
+def game_loop(world, veh, sensor, lane_sensor, lane_invasion_sensor, sensor_image_w, sensor_image_h, debug_every=1, workers=2, queue_size=4, recorder=None, profile_report=None, max_frames=None, start_time=None, predict_departures=True, frame_budget=None, preview_scale=1.0, detection_processes=0):
 
-    # instantiate objects for rendering and vehicle control
-    renderObject = RenderObject(sensor_image_w, sensor_image_h)
-    renderLaneObject = RenderObject(sensor_image_w, sensor_image_h)
-    renderPerspectiveObject = RenderObject(sensor_image_w, sensor_image_h)
-    renderSlidingObject = RenderObject(sensor_image_w, sensor_image_h)
-    renderLaneInvasionObject = pygame.Surface((sensor_image_w, sensor_image_h), pygame.SRCALPHA, 32)
+    # initialise PyGame window with one pane per view, shrunk by preview_scale
+    pygame.init()
+    hudFont = pygame.font.SysFont("monospace", 14)
+    renderer = Renderer(sensor_image_w, sensor_image_h, preview_scale=preview_scale)
+    controlPane = renderer.add_pane("control")
+    lanePane = renderer.add_pane("lane")
+    perspectivePane = renderer.add_pane("perspective")
+    slidingPane = renderer.add_pane("sliding windows")
+    warningOverlay = WarningOverlay(renderer.pane_w, renderer.pane_h)
+
+    # instantiate objects for vehicle control and lane detection
     controlObject = ControlObject(veh)
-
-    # start RGB sensors with PyGame callback
-    sensor.listen(lambda image: vehicle_control_callback(image, renderObject))
-    lane_sensor.listen(lambda image: lane_detection_callback(image, renderLaneObject, renderPerspectiveObject, renderSlidingObject, veh, sensor_image_w, sensor_image_h))
+    laneTracker = lane.LaneTracker()
+    departurePredictor = DeparturePredictor(sensor_image_h, sensor_image_w) if predict_departures else None
+    laneScheduler = FrameScheduler(frame_budget) if frame_budget else None
+
+    # process sensor data on worker threads, with results written into the panes in frame order
+    # frames are copied once out of the sensor buffers into pooled arrays
+    controlPool = BufferPool((sensor_image_h, sensor_image_w, 4), size=queue_size + 2)
+    controlPipeline = FramePipeline(vehicle_control_stage,
+        lambda frame: control_display_stage(frame, controlPane, controlPool),
+        workers=1, maxsize=queue_size, name="control", on_drop=lambda frame: controlPool.release(frame[1]))
+    onPredictedDeparture = lambda prediction: predicted_departure_callback(prediction, warningOverlay, controlObject)
+    if detection_processes > 0:
+        # lane detection in worker processes, the frames are copied into shared
+        # memory slots and only the fits come back. the debug panes stay empty
+        lanePipeline = ProcessDetector((sensor_image_h, sensor_image_w, 4),
+            lambda result: lane_display_stage(
+                lane_result_stage(result, veh, sensor_image_w, sensor_image_h, departurePredictor, onPredictedDeparture,
+                    laneScheduler),
+                lanePane, perspectivePane, slidingPane),
+            workers=detection_processes, slots=queue_size + 2*detection_processes, maxsize=queue_size, name="lane")
+        lanePool = lanePipeline.ring
+    else:
+        lanePool = BufferPool((sensor_image_h, sensor_image_w, 4), size=queue_size + 2*workers)
+        lanePipeline = FramePipeline(lane_processing_stage,
+            lambda result: lane_display_stage(
+                lane_tracking_stage(result, laneTracker, veh, sensor_image_w, sensor_image_h, debug_every, lanePool,
+                    departurePredictor, onPredictedDeparture, laneScheduler),
+                lanePane, perspectivePane, slidingPane),
+            workers=workers, maxsize=queue_size, name="lane", on_drop=lambda frame: lanePool.release(frame[1]))
+
+    # start RGB sensors with callbacks that queue their frames
+    sensor.listen(lambda image: vehicle_control_callback(image, controlPipeline, controlPool))
+    def lane_sensor_callback(image):
+        if recorder is not None:
+            record_frame_callback(image, recorder, veh, controlObject)
+        lane_detection_callback(image, lanePipeline, lanePool, sensor_image_w, sensor_image_h, laneScheduler)
+    lane_sensor.listen(lane_sensor_callback)
 
     # start lane invasion sensor with PyGame callback
-    lane_invasion_sensor.listen(lambda event: lane_departure_callback(event, renderLaneInvasionObject, controlObject))
+    lane_invasion_sensor.listen(lambda event: lane_departure_callback(event, warningOverlay, controlObject, recorder))
 
-    # initialise PyGame window
-    pygame.init()
-    gameDisplay = pygame.display.set_mode((sensor_image_w*2,sensor_image_h*2), pygame.HWSURFACE | pygame.DOUBLEBUF)
-    gameDisplay.blit(renderObject.surface, (0,0))
-    gameDisplay.blit(renderLaneInvasionObject, (0,0))
-    gameDisplay.blit(renderLaneObject.surface, (sensor_image_w, 0))
-    gameDisplay.blit(renderPerspectiveObject.surface, (0, sensor_image_h))
-    gameDisplay.blit(renderSlidingObject.surface, (sensor_image_w, sensor_image_h))
-    pygame.display.flip()
-
-    # game loop
+    renderer.present(renderer.draw())
+    if start_time is not None:
+        print("started in %.2f s" % (time.perf_counter() - start_time))
+
+    # game loop, which also ends after max_frames ticks or when a lane camera
+    # reading from a file runs out of frames
     crashed = False
+    ticks = 0
+    hudShown = False
+    loop_start = time.perf_counter()
     while not crashed:
 
         # advance the simulation time
         world.tick()
-
-        # update the display
-        gameDisplay.blit(renderObject.surface, (0,0))
-        gameDisplay.blit(renderLaneInvasionObject, (0,0))
-        gameDisplay.blit(renderLaneObject.surface, (sensor_image_w, 0))
-        gameDisplay.blit(renderPerspectiveObject.surface, (0, sensor_image_h))
-        gameDisplay.blit(renderSlidingObject.surface, (sensor_image_w, sensor_image_h))
-        pygame.display.flip()
+        ticks += 1
+        if (max_frames is not None and ticks >= max_frames) or lane_sensor.exhausted:
+            crashed = True
+
+        # frames were written into the panes by the pipelines, only note that they're on their way to the screen
+        for frame_id in controlPipeline.poll():
+            profiler.frame_displayed("control", frame_id)
+        for frame_id in lanePipeline.poll():
+            profiler.frame_displayed("lane", frame_id)
+
+        # panes under an overlay that changes are drawn again, as is the lane pane once the timings are hidden
+        if warningOverlay.alpha:
+            controlPane.invalidate()
+        if profiler.enabled or hudShown:
+            lanePane.invalidate()
+        hudShown = profiler.enabled
+
+        # update the parts of the display that changed
+        with profiler.span("display_update"):
+            rects = renderer.draw()
+            if warningOverlay.alpha and controlPane.rect in rects:
+                warningOverlay.draw(renderer.display, controlPane.rect.topleft)
+
+            # overlay the per stage timings while profiling
+            if profiler.enabled:
+                profiler.set_counter("lane kernels", kernels.BACKEND)
+                profiler.set_counter("lane frames dropped", lanePipeline.dropped)
+                profiler.set_counter("control frames dropped", controlPipeline.dropped)
+                if laneScheduler is not None:
+                    profiler.set_counter("lane detection scale", laneScheduler.scale)
+                    profiler.set_counter("lane detection skip", laneScheduler.skip)
+                    profiler.set_counter("lane frames skipped", laneScheduler.skipped)
+                draw_profiler_hud(renderer.display, hudFont)
+            renderer.present(rects)
 
         # fade out lane invasion symbol over time
-        renderLaneInvasionObject.set_alpha(renderLaneInvasionObject.get_alpha())
-        if(renderLaneInvasionObject.get_alpha() == 0):
-            pass
-        else:
-            renderLaneInvasionObject.set_alpha(renderLaneInvasionObject.get_alpha() - 2)
+        warningOverlay.fade()
 
         # process the current control state
         controlObject.process_control()
@@ -339,12 +591,31 @@ def game_loop(world, veh, sensor, lane_sensor, lane_invasion_sensor, sensor_imag
             if event.type == pygame.QUIT:
                 crashed = True
 
+            # toggle profiling and its on-screen display
+            if event.type == pygame.KEYDOWN and event.key == pygame.K_F3:
+                profiler.enabled = not profiler.enabled
+
             # parse effect of key press event on control state
             controlObject.parse_control(event)
-    
+
+    elapsed = time.perf_counter() - loop_start
     sensor.stop()
     lane_sensor.stop()
     lane_invasion_sensor.stop()
+    controlPipeline.stop()
+    lanePipeline.stop()
+    if recorder is not None:
+        recorder.close()
+        print("recorded %d frames to %s" % (recorder.frames_written, recorder.path))
+    if profile_report is not None:
+        profiler.dump(profile_report)
+        print("profile written to %s" % profile_report)
+    print("control pipeline: %s" % controlPipeline.stats())
+    print("lane pipeline: %s, %s kernels" % (lanePipeline.stats(), kernels.BACKEND))
+    print("display: %s" % renderer.stats())
+    if laneScheduler is not None:
+        print("lane scheduler: %s" % dict(laneScheduler.stats()))
+    print("%d ticks in %.2f s (%.1f FPS)" % (ticks, elapsed, ticks/elapsed if elapsed > 0 else 0.0))
     pygame.quit()
 
 
@@ -352,10 +623,53 @@ def game_loop(world, veh, sensor, lane_sensor, lane_invasion_sensor, sensor_imag
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Lane departure warning system in CARLA")
+    parser.add_argument("--record", metavar="PATH", help="record the lane camera to PATH for replay")
+    parser.add_argument("--record-compression", choices=["zlib", "lz4"], help="compress each chunk of the recording")
+    parser.add_argument("--profile", action="store_true", help="start with per stage profiling on, F3 toggles it")
+    parser.add_argument("--profile-report", metavar="PATH", help="write the profile to a json or csv file on exit")
+    parser.add_argument("--fake", action="store_true", help="run against the built in carla stand-in, which renders synthetic roads")
+    parser.add_argument("--source", metavar="PATH", help="feed the lane camera from a video, image directory, .npy stack, "
+                        "recording or \"synthetic\" instead, implies --fake")
+    parser.add_argument("--loop", action="store_true", help="start the --source again when it runs out")
+    parser.add_argument("--frames", type=int, help="stop after this many ticks")
+    parser.add_argument("--headless", action="store_true", help="run without a window or sound")
+    parser.add_argument("--preview-scale", type=float, default=1.0, help="shrink every pane of the window by this factor")
+    parser.add_argument("--no-predict", action="store_true", help="only warn once the lane invasion sensor fires")
+    parser.add_argument("--frame-budget", type=float, metavar="MS", help="shrink or skip lane detection to keep each frame within MS")
+    parser.add_argument("--detection-processes", type=int, default=0, metavar="N",
+                        help="run lane detection in N worker processes fed through shared memory")
+    args = parser.parse_args()
+    start_time = time.perf_counter()
+    profiler.enabled = args.profile
+    if args.headless:
+        os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+        os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+    source = None
+    sensor_image_w, sensor_image_h = 1280, 720
+    if args.fake or args.source:
+        import fake_carla
+        use_backend(fake_carla)
+    if args.source:
+        source = open_source(args.source, sensor_image_w, sensor_image_h, args.loop)
+        sensor_image_w, sensor_image_h = source.width, source.height
+
     world = init_world()
     vehicle, bp_library = init_vehicle(world)
-    sensor, lane_sensor, lane_invasion_sensor = init_vehicle_sensors(world, vehicle, bp_library)
-    game_loop(world, vehicle, sensor, lane_sensor, lane_invasion_sensor, 1280, 720)
+    sensor, lane_sensor, lane_invasion_sensor = init_vehicle_sensors(world, vehicle, bp_library, sensor_image_w, sensor_image_h)
+    # the lane camera is always a frame source, the simulator's own unless --source replaces it
+    if source is not None:
+        lane_sensor.destroy()
+        lane_sensor = world.attach_source(source)
+    else:
+        lane_sensor = CarlaSensorSource(lane_sensor)
+    recorder = None
+    if args.record:
+        recorder = FrameRecorder(args.record, sensor_image_w, sensor_image_h, compression=args.record_compression)
+    game_loop(world, vehicle, sensor, lane_sensor, lane_invasion_sensor, sensor_image_w, sensor_image_h, recorder=recorder,
+              profile_report=args.profile_report, max_frames=args.frames, start_time=start_time, predict_departures=not args.no_predict, frame_budget=args.frame_budget, preview_scale=args.preview_scale,
+              detection_processes=args.detection_processes)
 
 
 if __name__ == "__main__":
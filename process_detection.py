@@ -0,0 +1,327 @@
+import multiprocessing
+import queue
+import threading
+import time
+from collections import deque
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+#---SharedFrameRing----
+
+
+class SharedFrameRing(object):
+    # a ring of slots frames of one shape are kept in, in a shared memory block the
+    # detection worker processes map too, so a frame is only ever referred to by
+    # its slot number between processes and never pickled. acquire() and
+    # release() work like BufferPool's, so ingest_frame copies sensor frames
+    # straight into a slot. if every slot is taken acquire() falls back to a
+    # private array, which is counted in allocations and can't be sent to a worker
+    def __init__(self, shape, slots=8, dtype=np.uint8, name=None):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.slots = slots
+        self.allocations = 0
+        self.slot_bytes = int(np.prod(self.shape))*self.dtype.itemsize
+        self.owner = name is None
+        if self.owner:
+            self.memory = shared_memory.SharedMemory(create=True, size=self.slot_bytes*slots)
+        else:
+            # workers are spawned and share the creating process's resource
+            # tracker, which unlinks the block if that process dies without close()
+            self.memory = shared_memory.SharedMemory(name=name)
+        self.name = self.memory.name
+        self.frames = np.ndarray((slots,) + self.shape, self.dtype, buffer=self.memory.buf)
+        self._base = self.frames.__array_interface__["data"][0]
+        self._free = list(range(slots - 1, -1, -1))
+        self._lock = threading.Lock()
+
+    def frame(self, slot):
+        return self.frames[slot]
+
+    # slot a buffer handed out by acquire() sits in, or None if it isn't one
+    def slot_of(self, buffer):
+        if buffer is None or buffer.shape != self.shape or buffer.dtype != self.dtype:
+            return None
+        offset = buffer.__array_interface__["data"][0] - self._base
+        if offset < 0 or offset % self.slot_bytes or offset//self.slot_bytes >= self.slots:
+            return None
+        return offset//self.slot_bytes
+
+    def acquire(self):
+        with self._lock:
+            if self._free:
+                return self.frames[self._free.pop()]
+            self.allocations += 1
+        return np.empty(self.shape, self.dtype)
+
+    def release(self, buffer):
+        slot = self.slot_of(buffer)
+        if slot is None:
+            return
+        with self._lock:
+            if slot not in self._free:
+                self._free.append(slot)
+
+    @property
+    def free(self):
+        with self._lock:
+            return len(self._free)
+
+    def close(self):
+        self.frames = None
+        try:
+            self.memory.close()
+        except BufferError:
+            # a view of a slot is still alive somewhere, the mapping goes with
+            # the process instead
+            pass
+        if self.owner:
+            self.memory.unlink()
+
+
+#---detect_slot()----
+
+
+def detect_slot(ring, trackers, request, process_mode="full"):
+    # run lane detection on the frame in one slot of the ring with the stream's
+    # own tracker. a scale of None reuses the tracker's last fit, as the
+    # scheduler asks for. only the fits and metrics go back to the main process,
+    # and any error goes back as its message so the worker carries on
+    import lane_detection as lane
+    import process_image as process
+
+    stream, frame_id, slot, scale, height, width = request
+    start = time.perf_counter()
+    tracker = trackers.get(stream)
+    if tracker is None:
+        tracker = trackers[stream] = lane.LaneTracker()
+    try:
+        img_ = None
+        if scale is not None:
+            img_ = process.process_scaled(ring.frame(slot), height, width, scale, process_mode)
+        detection, fits, metrics = lane.track_scaled(tracker, img_, height, width, scale)
+    except Exception as error:
+        return stream, frame_id, slot, scale, None, None, None, (time.perf_counter() - start)*1000, str(error)
+    search = detection.search if detection is not None else "skipped"
+    return (stream, frame_id, slot, scale, np.asarray(fits, np.float64), tuple(float(value) for value in metrics),
+            search, (time.perf_counter() - start)*1000, None)
+
+
+#---_detection_worker()----
+
+
+def _detection_worker(ring_name, shape, slots, requests, results, process_mode):
+    # body of a worker process: map the ring and detect the frames of the streams
+    # assigned to this worker in the order they were sent, until given None
+    ring = SharedFrameRing(shape, slots, name=ring_name)
+    trackers = {}
+    try:
+        while True:
+            request = requests.get()
+            if request is None:
+                return
+            results.put(detect_slot(ring, trackers, request, process_mode))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        ring.close()
+
+
+#---ProcessDetector----
+
+
+class ProcessDetector(object):
+    # lane detection in a pool of worker processes, for when thresholding and the
+    # window search are too slow to keep up on threads. frames are submitted
+    # the way FramePipeline takes them, (frame_id, buffer, width, height, scale),
+    # with buffer from ring.acquire(), and only the slot number crosses to the
+    # worker. every stream is pinned to one worker, which keeps that stream's
+    # LaneTracker, so a stream's frames are detected in order by the same tracker
+    # and several streams are needed to keep several workers busy. a collector
+    # thread runs result_stage on each result with a view of its frame, while
+    # the slot is still held, then frees the slot and queues the return value
+    # for poll(). each worker is sent one frame at a time and the rest wait
+    # here, so like FramePipeline's queue the oldest waiting frame is dropped
+    # when more than maxsize are waiting, or when a frame finds every slot of
+    # the ring taken, in which case it is copied into the dropped frame's slot.
+    # a worker process that dies is counted as an error and started again, the
+    # frame it was working on is dropped and its streams start a new tracker
+    def __init__(self, shape, result_stage=None, workers=2, slots=8, process_mode="full", name="detector", maxsize=None):
+        self.result_stage = result_stage
+        self.name = name
+        self.workers = workers
+        self.maxsize = maxsize
+        self.submitted = 0
+        self.processed = 0
+        self.delivered = 0
+        self.errors = 0
+        self.last_error = None
+        self._dropped = 0
+
+        self.ring = SharedFrameRing(shape, slots)
+        self._lock = threading.Lock()
+        self._results = deque()
+        self._in_flight = 0
+        self._worker_of = {}
+        self._waiting = deque()
+        self._busy = [False]*workers
+        self._sent = [None]*workers
+        self._stopping = False
+        self._process_mode = process_mode
+        self._context = multiprocessing.get_context("spawn")
+        self._requests = [None]*workers
+        self._result_queue = self._context.Queue()
+        self._processes = [None]*workers
+        for worker in range(workers):
+            self._start_worker(worker)
+        self._collector = threading.Thread(target=self._collect, name="%s-collector" % name, daemon=True)
+        self._collector.start()
+
+    # start the process of one worker with a queue of its own, so a process that
+    # died while reading its queue can't leave the new one locked out
+    def _start_worker(self, worker):
+        self._requests[worker] = self._context.Queue()
+        self._processes[worker] = self._context.Process(
+            target=_detection_worker, name="%s-process-%d" % (self.name, worker), daemon=True,
+            args=(self.ring.name, self.ring.shape, self.ring.slots, self._requests[worker], self._result_queue,
+                  self._process_mode))
+        self._processes[worker].start()
+
+    @property
+    def dropped(self):
+        return self._dropped
+
+    def stats(self):
+        with self._lock:
+            return {"submitted": self.submitted, "dropped": self._dropped, "processed": self.processed,
+                    "delivered": self.delivered, "errors": self.errors, "queued": self._in_flight,
+                    "processes": self.workers, "ring_allocations": self.ring.allocations}
+
+    # called from the sensor callback, only sends the frame's slot to the worker
+    # that owns the stream, or leaves it waiting until that worker is free
+    def submit(self, frame, stream=0):
+        frame_id, buffer, width, height, scale = frame
+        slot = self.ring.slot_of(buffer)
+        with self._lock:
+            self.submitted += 1
+            if slot is None:
+                if not self._waiting:
+                    self._dropped += 1
+                    return None
+                slot = self._drop_oldest(release=False)
+                self.ring.frame(slot)[...] = buffer
+            worker = self._worker_of.get(stream)
+            if worker is None:
+                worker = self._worker_of[stream] = len(self._worker_of) % self.workers
+            self._in_flight += 1
+            self._waiting.append((worker, (stream, frame_id, slot, scale, height, width)))
+            if self.maxsize is not None and len(self._waiting) > self.maxsize:
+                self._drop_oldest()
+            self._dispatch(worker)
+        return slot
+
+    # forget the oldest waiting frame and return its slot, freed unless it is
+    # about to be reused. called with the lock held
+    def _drop_oldest(self, release=True):
+        _, request = self._waiting.popleft()
+        self._dropped += 1
+        self._in_flight -= 1
+        if release:
+            self.ring.release(self.ring.frame(request[2]))
+        return request[2]
+
+    # send the oldest frame waiting for a worker to it if it is idle. called with
+    # the lock held
+    def _dispatch(self, worker):
+        if self._busy[worker]:
+            return
+        for i, (owner, request) in enumerate(self._waiting):
+            if owner == worker:
+                del self._waiting[i]
+                self._busy[worker] = True
+                self._sent[worker] = request
+                self._requests[worker].put(request)
+                return
+
+    # return the results completed since the last poll, oldest first
+    def poll(self):
+        with self._lock:
+            results = list(self._results)
+            self._results.clear()
+        return results
+
+    def stop(self, timeout=1.0):
+        self._stopping = True
+        for requests in self._requests:
+            requests.put(None)
+        for process in self._processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+        self._result_queue.put(None)
+        self._collector.join(timeout)
+        self.ring.close()
+
+    # restart the workers whose process has exited, dropping the frame each was
+    # sent. called from the collector about twice a second
+    def _restart_dead_workers(self):
+        for worker, process in enumerate(self._processes):
+            if process.is_alive() or self._stopping:
+                continue
+            with self._lock:
+                self.errors += 1
+                self.last_error = RuntimeError("%s exited with code %s and was restarted" % (process.name, process.exitcode))
+                request, self._sent[worker] = self._sent[worker], None
+                if request is not None:
+                    self._in_flight -= 1
+                    self._dropped += 1
+                    self.ring.release(self.ring.frame(request[2]))
+                self._start_worker(worker)
+                self._busy[worker] = False
+                self._dispatch(worker)
+
+    def _collect(self):
+        checked = time.monotonic()
+        while True:
+            if time.monotonic() - checked > 0.5:
+                self._restart_dead_workers()
+                checked = time.monotonic()
+            try:
+                result = self._result_queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            except (EOFError, OSError):
+                return
+            if result is None:
+                return
+            stream, frame_id, slot, scale, fits, metrics, search, detection_ms, error = result
+            with self._lock:
+                worker = self._worker_of[stream]
+                sent = self._sent[worker]
+                if sent is None or sent[:3] != (stream, frame_id, slot):
+                    # from a worker that has since been restarted, its slot is already free
+                    continue
+                self._sent[worker] = None
+                self._in_flight -= 1
+                self.processed += 1
+                self._busy[worker] = False
+                self._dispatch(worker)
+            output = None
+            try:
+                if self.result_stage is not None:
+                    output = self.result_stage((stream, frame_id, self.ring.frame(slot), scale, fits, metrics,
+                                                search, detection_ms, error))
+                else:
+                    output = result
+            except Exception as error:
+                with self._lock:
+                    self.errors += 1
+                    self.last_error = error
+                continue
+            finally:
+                self.ring.release(self.ring.frame(slot))
+            with self._lock:
+                self._results.append(output)
+                self.delivered += 1
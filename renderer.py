@@ -0,0 +1,118 @@
+import threading
+
+import cv2
+import pygame
+from frame_ingest import PersistentSurface
+
+
+#---Pane----
+
+
+class Pane(object):
+    # one region of the window showing a stream of frames. frames are written into
+    # a back buffer by whichever thread produces them and then swapped with the
+    # front buffer, under the lock the game loop holds while blitting the front
+    # buffer, so a surface is never written while it is on its way to the screen
+    def __init__(self, name, x, y, width, height):
+        self.name = name
+        self.rect = pygame.Rect(x, y, width, height)
+        self.frames = 0
+        self.dirty = True
+        self._front = PersistentSurface(width, height)
+        self._back = PersistentSurface(width, height)
+        self._front.pixels[:] = 0
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+
+    # copy a bgra, rgb or single channel image in, shrinking it to the pane size
+    # if needed. arguments are as for PersistentSurface.update
+    def update(self, img, bgr=False, scale=1):
+        with self._write_lock:
+            if img.shape[:2] != (self.rect.height, self.rect.width):
+                interpolation = cv2.INTER_AREA if img.ndim == 3 else cv2.INTER_NEAREST
+                img = cv2.resize(img, self.rect.size, interpolation=interpolation)
+            self._back.update(img, bgr, scale)
+            with self._lock:
+                self._front, self._back = self._back, self._front
+                self.dirty = True
+                self.frames += 1
+
+    # redraw on the next draw even without a new frame, e.g. under an overlay
+    def invalidate(self):
+        self.dirty = True
+
+    def blit(self, display):
+        with self._lock:
+            display.blit(self._front.surface, self.rect.topleft)
+            self.dirty = False
+
+
+#---WarningOverlay----
+
+
+class WarningOverlay(object):
+    # the lane departure warning icon shown over a pane. show() can be called from
+    # any thread, the game loop fades it out a little on every tick
+    def __init__(self, width, height, icon_path="warning_icon.png"):
+        self.surface = pygame.Surface((width, height), pygame.SRCALPHA, 32)
+        self.surface.blit(pygame.image.load(icon_path), (10, 10))
+        self.alpha = 0
+        self._lock = threading.Lock()
+
+    def show(self):
+        with self._lock:
+            self.alpha = 255
+
+    def fade(self, step=2):
+        with self._lock:
+            self.alpha = max(self.alpha - step, 0)
+
+    def draw(self, display, position):
+        self.surface.set_alpha(self.alpha)
+        display.blit(self.surface, position)
+
+
+#---Renderer----
+
+
+class Renderer(object):
+    # a window of columns x rows panes for frames of frame_w x frame_h, shrunk by
+    # preview_scale. draw() blits only the panes that changed since the last call
+    # and present() updates just those parts of the screen
+    def __init__(self, frame_w, frame_h, columns=2, rows=2, preview_scale=1.0, caption="Lane departure warning"):
+        self.pane_w = max(int(round(frame_w*preview_scale)), 1)
+        self.pane_h = max(int(round(frame_h*preview_scale)), 1)
+        self.columns = columns
+        self.rows = rows
+        self.display = pygame.display.set_mode((self.pane_w*columns, self.pane_h*rows))
+        pygame.display.set_caption(caption)
+        self.panes = []
+        self.frames_presented = 0
+        self.panes_drawn = 0
+
+    def add_pane(self, name):
+        index = len(self.panes)
+        if index >= self.columns*self.rows:
+            raise ValueError("no room left for pane %s" % name)
+        pane = Pane(name, (index % self.columns)*self.pane_w, (index//self.columns)*self.pane_h, self.pane_w, self.pane_h)
+        self.panes.append(pane)
+        return pane
+
+    # blit the panes that changed and return the rectangles that were drawn
+    def draw(self):
+        rects = []
+        for pane in self.panes:
+            if pane.dirty:
+                pane.blit(self.display)
+                rects.append(pane.rect)
+        self.panes_drawn += len(rects)
+        return rects
+
+    def present(self, rects):
+        if rects:
+            pygame.display.update(rects)
+            self.frames_presented += 1
+
+    def stats(self):
+        return {"frames_presented": self.frames_presented, "panes_drawn": self.panes_drawn,
+                "pane_frames": {pane.name: pane.frames for pane in self.panes}}
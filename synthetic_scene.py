@@ -0,0 +1,92 @@
+import numpy as np
+import cv2
+import process_image as process
+
+
+#---lane_lines()----
+
+
+def lane_lines(height, width, bend=0.0, lane_centre=0.5, lane_width=0.4, adjacent=0):
+    # ground truth lane line polynomials x = a*y**2 + b*y + c in bird's-eye
+    # pixel coordinates. the ego lane's two lines are lane_width*width apart
+    # around lane_centre at the bottom of the image and curve sideways by
+    # bend*width at the top, with adjacent more lines lane_width*width apart on
+    # either side, left to right
+    bottom = height - 1
+    a = bend*width/bottom**2
+    fits = []
+    for line in range(-adjacent, adjacent + 2):
+        base = lane_centre - lane_width/2 + line*lane_width
+        fits.append(np.array([a, -2*a*bottom, a*bottom**2 + base*width]))
+    return fits
+
+
+#---draw_line()----
+
+
+def draw_line(img, fit, thickness, colour, dash_length=0, gap_length=0):
+    # draw a polynomial lane line, solid or as dashes of dash_length rows
+    polyline = np.arange(img.shape[0])
+    fit_x = fit[0]*polyline**2 + fit[1]*polyline + fit[2]
+    points = np.int32(np.column_stack((fit_x, polyline)))
+    if not dash_length:
+        cv2.polylines(img, [points], False, colour, thickness)
+        return
+    for start in range(img.shape[0] - 1, -1, -(dash_length + gap_length)):
+        segment = points[max(start - dash_length, 0):start + 1]
+        if len(segment) > 1:
+            cv2.polylines(img, [segment], False, colour, thickness)
+
+
+#---generate_scene()----
+
+
+def generate_scene(height=720, width=1280, bend=0.0, dashed=(False, False), noise=20, shadows=0,
+                   lane_centre=0.5, lane_width=0.4, seed=0, adjacent=0):
+    # render a bgra road frame as the lane camera would see it, together with the
+    # ground truth (left, right) polynomials of its lane lines in the bird's-eye
+    # view that process_image warps to. dashed picks dashed markings per side,
+    # noise is the amplitude of the pixel noise and shadows the number of dark
+    # patches thrown across the road. adjacent adds that many neighbouring lanes
+    # on either side, bounded by solid lines
+    rng = np.random.default_rng(seed)
+    fits = lane_lines(height, width, bend, lane_centre, lane_width, adjacent)
+    left_fit, right_fit = fits[adjacent], fits[adjacent + 1]
+    line_dashed = [False]*adjacent + list(dashed) + [False]*adjacent
+
+    # draw the road and its markings from above, then project them into the camera
+    # view, extending the road surface out to the sides of the frame
+    road = np.full((height, width, 4), 90, np.uint8)
+    road[..., 3] = 255
+    thickness = max(width//60, 2)
+    dash_length, gap_length = height//8, height//10
+    for fit, is_dashed in zip(fits, line_dashed):
+        draw_line(road, fit, thickness, (235, 235, 235, 255), dash_length if is_dashed else 0, gap_length)
+    transform_matrix = process.warper.transform_matrix((width, height), (width, height), warp_type="")
+    frame = cv2.warpPerspective(road, transform_matrix, (width, height), borderMode=cv2.BORDER_REPLICATE)
+
+    # fill everything above the road with a bright sky
+    horizon = int(process.LANE_QUAD[0][1]*height)
+    frame[:horizon, :, :3] = (210, 190, 170)
+    frame[:horizon, :, 3] = 255
+
+    # darken random patches of the road to imitate shadows
+    for _ in range(shadows):
+        x, y = rng.integers(0, width), rng.integers(horizon, height)
+        w, h = rng.integers(width//10, width//3), rng.integers(height//20, height//6)
+        patch = frame[y:y + h, x:x + w, :3]
+        patch[:] = patch//2
+
+    if noise:
+        grain = rng.normal(0, noise, frame.shape[:2] + (1,))
+        frame[..., :3] = np.clip(frame[..., :3] + grain, 0, 255).astype(np.uint8)
+    return frame, (left_fit, right_fit)
+
+
+#---fit_error()----
+
+
+def fit_error(fit, truth, height):
+    # mean absolute horizontal distance in pixels between two polynomial lines
+    polyline = np.arange(height)
+    return float(np.mean(np.abs(np.polyval(fit, polyline) - np.polyval(truth, polyline))))